@@ -0,0 +1,62 @@
+#
+# Copyright(c) 2022 WIZnet Co., Ltd
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+
+# Downloads a file straight to the Pico's flash. The body goes through one
+# small buffer, so files much larger than the free RAM work too. If the
+# transfer breaks off it's retried from where it stopped, and running the
+# script again after a reset resumes the partial file
+
+import machine
+import adafruit_requests as requests
+from adafruit_wizfiatcontrol_socket import SocketPool
+from adafruit_wizfiatcontrol import WizFi_ATcontrol
+
+# Get wifi details and more from a secrets.py file
+try:
+    from secrets import secrets
+except ImportError:
+    print("Wi-Fi secrets are kept in secrets.py, please add them there!")
+    raise
+
+# Debug Level
+# Change the Debug Flag if you have issues with AT commands
+debugflag = False
+
+# WizFi360 configuration
+PORT=1
+RX = 5
+TX = 4
+resetpin = 20
+rtspin = False
+
+UART_Tx_BUFFER_LENGTH = 1024
+UART_Rx_BUFFER_LENGTH = 1024*2
+
+URL="http://httpbin.org/range/65536"
+FILE="download.bin"
+
+uart = machine.UART(PORT, 115200, tx= machine.Pin(TX), rx= machine.Pin(RX), txbuf=UART_Tx_BUFFER_LENGTH, rxbuf=UART_Rx_BUFFER_LENGTH)
+wizfi = WizFi_ATcontrol( uart, 115200, reset_pin=resetpin, rts_pin=rtspin, debug=debugflag )
+
+print("Resetting WizFi360 module")
+wizfi.hard_reset()
+wizfi.connect(secrets)
+session = requests.Session(SocketPool(wizfi))
+
+
+def show_progress(received, total):
+    if total:
+        print("\r{0}/{1} bytes".format(received, total), end="")
+    else:
+        print("\r{0} bytes".format(received), end="")
+
+
+stats = session.download(URL, FILE, buffer_size=1024, progress=show_progress)
+print()
+print("Saved {0} bytes to {1} in {2} ms ({3} bytes/s)".format(
+    stats["bytes"], FILE, stats["ms"], stats["bytes_per_s"]))
+if stats["resumed_from"] or stats["retries"]:
+    print("Resumed from byte {0}, {1} retries".format(stats["resumed_from"], stats["retries"]))
@@ -0,0 +1,79 @@
+#
+# Copyright(c) 2022 WIZnet Co., Ltd
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+
+# Compares sending each piece of an HTTP request with its own CIPSEND
+# (send_buffer_size=0) against serializing the whole request into one buffer
+
+import time
+import machine
+import adafruit_requests as requests
+from adafruit_wizfiatcontrol_socket import SocketPool
+from adafruit_wizfiatcontrol import WizFi_ATcontrol
+
+# Get wifi details and more from a secrets.py file
+try:
+    from secrets import secrets
+except ImportError:
+    print("Wi-Fi secrets are kept in secrets.py, please add them there!")
+    raise
+
+# Debug Level
+# Change the Debug Flag if you have issues with AT commands
+debugflag = False
+
+# WizFi360 configuration
+PORT=1
+RX = 5
+TX = 4
+resetpin = 20
+rtspin = False
+
+UART_Tx_BUFFER_LENGTH = 1024
+UART_Rx_BUFFER_LENGTH = 1024*2
+
+URL="http://httpbin.org/get"
+HEADERS = {
+    "Accept": "application/json",
+    "Cache-Control": "no-cache",
+    "X-Device": "wizfi360-evb-pico",
+}
+REQUESTS = 10
+
+uart = machine.UART(PORT, 115200, tx= machine.Pin(TX), rx= machine.Pin(RX), txbuf=UART_Tx_BUFFER_LENGTH, rxbuf=UART_Rx_BUFFER_LENGTH)
+wizfi = WizFi_ATcontrol( uart, 115200, reset_pin=resetpin, rts_pin=rtspin, debug=debugflag )
+
+print("Resetting WizFi360 module")
+wizfi.hard_reset()
+wizfi.connect(secrets)
+pool = SocketPool(wizfi)
+
+
+def benchmark(name, session):
+    total = 0
+    for _ in range(REQUESTS):
+        stamp = time.ticks_ms()
+        response = session.get(URL, headers=HEADERS)
+        # time to the status line, that's where the request cost shows
+        total += time.ticks_diff(time.ticks_ms(), stamp)
+        response.close()
+    print("{0}: {1} ms per request".format(name, total // REQUESTS))
+    return total
+
+
+pieces = benchmark("one send per piece", requests.Session(pool, send_buffer_size=0))
+single = benchmark("single buffer", requests.Session(pool))
+print("Speedup: {0:.1f}x".format(pieces / max(single, 1)))
+
+# where the time goes, phase by phase
+stats = requests.TimingStats()
+session = requests.Session(pool, timings=stats)
+for _ in range(REQUESTS):
+    session.get(URL, headers=HEADERS).close()
+for phase, percentiles in stats.report().items():
+    print("{0:>14}: p50 {1} ms, p90 {2} ms, p99 {3} ms".format(
+        phase, percentiles[50], percentiles[90], percentiles[99]))
+print("{0} requests, {1} on a kept-alive connection, {2} retries".format(
+    stats.count, stats.reused, stats.retries))
@@ -0,0 +1,91 @@
+#
+# Copyright(c) 2022 WIZnet Co., Ltd
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+
+# Compares publish throughput of the WizFi360 firmware MQTT commands
+# (AT+MQTTPUB) with the socket based client in adafruit_wizfiatcontrol_minimqtt,
+# at QoS 0 and QoS 1. Watch the messages arrive with
+#   mosquitto_sub -h BROKER_IP -t "bench/#" -v
+
+import time
+import machine
+import adafruit_wizfiatcontrol_socket as socket
+from adafruit_wizfiatcontrol import WizFi_ATcontrol
+from adafruit_wizfiatcontrol_minimqtt import MQTT
+
+# Get wifi details and more from a secrets.py file
+try:
+    from secrets import secrets
+except ImportError:
+    print("Wi-Fi secrets are kept in secrets.py, please add them there!")
+    raise
+
+# Debug Level
+# Change the Debug Flag if you have issues with AT commands
+debugflag = False
+
+# For WizFi
+PORT=1
+RX = 5
+TX = 4
+resetpin = 20
+rtspin = False
+
+UART_Tx_BUFFER_LENGTH = 1024
+UART_Rx_BUFFER_LENGTH = 1024*2
+
+# Target settings
+BROKER_IP = "192.168.11.100"
+BROKER_PORT = 1883
+
+USERNAME = "wiznet"
+PASSWORD = "0123456789"
+CLIENT_ID = "rpi-pico"
+KEEP_ALIVE = 10
+AUTH_ENABLE = 0
+
+# Benchmark settings
+MESSAGES = 50
+PAYLOAD = b"0123456789" * 4
+
+uart = machine.UART(PORT, 115200, tx= machine.Pin(TX), rx= machine.Pin(RX), txbuf=UART_Tx_BUFFER_LENGTH, rxbuf=UART_Rx_BUFFER_LENGTH)
+wizfi = WizFi_ATcontrol( uart, 115200, reset_pin=resetpin, rts_pin=rtspin, debug=debugflag )
+
+print("Resetting WizFi360 module")
+wizfi.hard_reset()
+wizfi.connect(secrets)
+
+def report(name, start):
+    elapsed = time.ticks_diff(time.ticks_ms(), start)
+    print("{0}: {1} msgs in {2} ms, {3:.1f} msgs/s".format(
+        name, MESSAGES, elapsed, MESSAGES * 1000 / elapsed))
+
+# Firmware MQTT, one topic fixed by AT+MQTTTOPIC
+wizfi.mqtt_userinfo_config(USERNAME, PASSWORD, CLIENT_ID, KEEP_ALIVE)
+wizfi.mqtt_set_topic("bench/at", "bench/in")
+if wizfi.mqtt_connect(AUTH_ENABLE, BROKER_IP, BROKER_PORT):
+    start = time.ticks_ms()
+    for _ in range(MESSAGES):
+        wizfi.mqtt_publish(PAYLOAD)
+    report("AT+MQTTPUB", start)
+    wizfi.mqtt_disconnect()
+else:
+    print("Firmware MQTT could not connect")
+
+# Socket client, any topic per message
+socket.set_interface(wizfi)
+client = MQTT(socket, BROKER_IP, BROKER_PORT, client_id=CLIENT_ID,
+              username=USERNAME if AUTH_ENABLE else None,
+              password=PASSWORD if AUTH_ENABLE else None,
+              keep_alive=KEEP_ALIVE)
+client.connect()
+for qos in (0, 1):
+    start = time.ticks_ms()
+    for i in range(MESSAGES):
+        client.publish("bench/socket/qos%d/%d" % (qos, i % 4), PAYLOAD, qos=qos)
+    while client.inflight:
+        client.loop()
+    report("socket MQTT QoS %d" % qos, start)
+client.disconnect()
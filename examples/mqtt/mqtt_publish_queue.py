@@ -0,0 +1,84 @@
+#
+# Copyright(c) 2022 WIZnet Co., Ltd
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+
+# Samples a value every SAMPLE_INTERVAL and publishes it through a
+# PublishQueue, so samples taken while the broker or AP is down are kept
+# (in RAM, then on flash) and sent in batches once the link is back.
+
+import time
+import machine
+from adafruit_wizfiatcontrol import WizFi_ATcontrol
+from adafruit_wizfiatcontrol_mqtt import PublishQueue
+
+# Get wifi details and more from a secrets.py file
+try:
+    from secrets import secrets
+except ImportError:
+    print("Wi-Fi secrets are kept in secrets.py, please add them there!")
+    raise
+
+# Debug Level
+# Change the Debug Flag if you have issues with AT commands
+debugflag = False
+
+# How long between samples
+SAMPLE_INTERVAL = 1000  # in milliseconds
+
+# For WizFi
+PORT=1
+RX = 5
+TX = 4
+resetpin = 20
+rtspin = False
+
+UART_Tx_BUFFER_LENGTH = 1024
+UART_Rx_BUFFER_LENGTH = 1024*2
+
+# Target settings
+BROKER_IP = "192.168.11.100"
+BROKER_PORT = 1883
+
+USERNAME = "wiznet"
+PASSWORD = "0123456789"
+CLIENT_ID = "rpi-pico"
+KEEP_ALIVE = 10
+AUTH_ENABLE = 0
+
+PUBLISH_TOPIC = "publish_topic"
+SUBSCRIBE_TOPIC = "subscribe_topic"
+
+uart = machine.UART(PORT, 115200, tx= machine.Pin(TX), rx= machine.Pin(RX), txbuf=UART_Tx_BUFFER_LENGTH, rxbuf=UART_Rx_BUFFER_LENGTH)
+wizfi = WizFi_ATcontrol( uart, 115200, reset_pin=resetpin, rts_pin=rtspin, debug=debugflag )
+
+print("Resetting WizFi360 module")
+wizfi.hard_reset()
+wizfi.connect(secrets)
+
+wizfi.mqtt_userinfo_config(USERNAME, PASSWORD, CLIENT_ID, KEEP_ALIVE)
+wizfi.mqtt_set_topic(PUBLISH_TOPIC, SUBSCRIBE_TOPIC)
+
+queue = PublishQueue(
+    wizfi,
+    BROKER_IP,
+    BROKER_PORT,
+    AUTH_ENABLE,
+    max_messages=32,
+    spill_path="mqtt_spill.bin",
+    drop_policy="oldest",
+)
+
+sensor = machine.ADC(4)  # on-chip temperature sensor
+next_sample = time.ticks_ms()
+dropped = 0
+while True:
+    if time.ticks_diff(time.ticks_ms(), next_sample) >= 0:
+        next_sample = time.ticks_add(next_sample, SAMPLE_INTERVAL)
+        queue.publish(b"%d" % sensor.read_u16())
+    # only does work when something is queued and the link is (or can be) up
+    queue.service(max_publishes=1)
+    if queue.dropped != dropped:
+        dropped = queue.dropped
+        print("Dropped", dropped, "samples,", queue.pending, "pending")
@@ -7,6 +7,7 @@
 import time
 import machine 
 from adafruit_wizfiatcontrol import WizFi_ATcontrol
+from adafruit_wizfiatcontrol_mqtt import MQTTDispatcher, MQTTSupervisor
 
 # Get wifi details and more from a secrets.py file
 try:
@@ -47,7 +48,7 @@ KEEP_ALIVE = 10
 # Topic settings
 PUBLISH_TOPIC = "publish_topic"
 SUBSCRIBE_TOPIC = "subscribe_topic"
-pub_data = b"Hello, World!\r\n"
+pub_data = b"Hello, World!"
 
 # Authentication settings
 AUTH_ENABLE = 0
@@ -65,25 +66,29 @@ wizfi.hard_reset()
 print("AT software version: ", wizfi.get_version())
 wizfi.connect(secrets)
 
+def message_received(topic, payload):
+    print("recv", topic, "/", payload)
+
+dispatcher = MQTTDispatcher(wizfi)
+dispatcher.subscribe(SUBSCRIBE_TOPIC, message_received)
+
 wizfi.mqtt_userinfo_config(USERNAME, PASSWORD, CLIENT_ID, KEEP_ALIVE)
-wizfi.mqtt_set_topic(PUBLISH_TOPIC, SUBSCRIBE_TOPIC)
+dispatcher.register(PUBLISH_TOPIC)
+
+# reconnects the AP and broker by itself, with backoff
+supervisor = MQTTSupervisor(wizfi, BROKER_IP, BROKER_PORT, AUTH_ENABLE,
+                            secrets=secrets, keep_alive=KEEP_ALIVE)
 
 while True:
-    while not wizfi.is_connected:
-        print("Connecting to AP...")
-        wizfi.connect(secrets)                
-    while not is_broker_connected:
-        print("Connecting to broker...")
-        is_broker_connected = wizfi.mqtt_connect(AUTH_ENABLE, BROKER_IP, BROKER_PORT)
-        if is_broker_connected:
-            print("Connected to ", BROKER_IP, ":", BROKER_PORT, sep="")
-        
+    was_connected = is_broker_connected
+    is_broker_connected = supervisor.service()
+    if is_broker_connected and not was_connected:
+        print("Connected to ", BROKER_IP, ":", BROKER_PORT, sep="")
         #publish
-        is_socket_sent = wizfi.mqtt_publish(pub_data)
+        is_socket_sent = supervisor.publish(pub_data)
         if is_socket_sent:
             print("Send OK")
-        #subscribe
-        while True:
-            wizfi.mqtt_subscribe(SUBSCRIBE_TOPIC)
-
-
+    elif was_connected and not is_broker_connected:
+        print("Connecting to broker...")
+    #subscribe
+    dispatcher.poll()
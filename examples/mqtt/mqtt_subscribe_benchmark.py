@@ -0,0 +1,88 @@
+#
+# Copyright(c) 2022 WIZnet Co., Ltd
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+
+# Counts how many MQTT messages per second the dispatcher can take in.
+# Flood the subscribe topics from your PC while this runs, e.g.
+#   for i in $(seq 1000); do mosquitto_pub -h BROKER_IP -t bench/a -m $i; done
+
+import time
+import machine
+from adafruit_wizfiatcontrol import WizFi_ATcontrol
+from adafruit_wizfiatcontrol_mqtt import MQTTDispatcher
+
+# Get wifi details and more from a secrets.py file
+try:
+    from secrets import secrets
+except ImportError:
+    print("Wi-Fi secrets are kept in secrets.py, please add them there!")
+    raise
+
+# Debug Level
+# Change the Debug Flag if you have issues with AT commands
+debugflag = False
+
+# For WizFi
+PORT=1
+RX = 5
+TX = 4
+resetpin = 20
+rtspin = False
+
+UART_Tx_BUFFER_LENGTH = 1024
+UART_Rx_BUFFER_LENGTH = 1024*2
+
+# Target settings
+BROKER_IP = "192.168.11.100"
+BROKER_PORT = 1883
+
+USERNAME = "wiznet"
+PASSWORD = "0123456789"
+CLIENT_ID = "rpi-pico"
+KEEP_ALIVE = 10
+AUTH_ENABLE = 0
+
+PUBLISH_TOPIC = "bench/out"
+SUBSCRIBE_TOPICS = ("bench/a", "bench/b")
+
+# Benchmark settings
+REPORT_INTERVAL = 5  # in seconds
+
+uart = machine.UART(PORT, 115200, tx= machine.Pin(TX), rx= machine.Pin(RX), txbuf=UART_Tx_BUFFER_LENGTH, rxbuf=UART_Rx_BUFFER_LENGTH)
+wizfi = WizFi_ATcontrol( uart, 115200, reset_pin=resetpin, rts_pin=rtspin, debug=debugflag )
+
+print("Resetting WizFi360 module")
+wizfi.hard_reset()
+wizfi.connect(secrets)
+
+counts = {}
+
+def message_received(topic, payload):
+    counts[topic] = counts.get(topic, 0) + 1
+
+dispatcher = MQTTDispatcher(wizfi)
+for topic in SUBSCRIBE_TOPICS:
+    dispatcher.subscribe(topic, message_received)
+
+wizfi.mqtt_userinfo_config(USERNAME, PASSWORD, CLIENT_ID, KEEP_ALIVE)
+dispatcher.register(PUBLISH_TOPIC)
+while not wizfi.mqtt_connect(AUTH_ENABLE, BROKER_IP, BROKER_PORT):
+    print("Connecting to broker...")
+print("Connected, waiting for messages on", SUBSCRIBE_TOPICS)
+
+total = 0
+polls = 0
+start = time.ticks_ms()
+while True:
+    total += dispatcher.poll()
+    polls += 1
+    elapsed = time.ticks_diff(time.ticks_ms(), start)
+    if elapsed >= REPORT_INTERVAL * 1000:
+        print("{0} msgs in {1} ms: {2:.1f} msgs/s, {3} polls, per topic {4}".format(
+            total, elapsed, total * 1000 / elapsed, polls, counts))
+        total = 0
+        polls = 0
+        counts.clear()
+        start = time.ticks_ms()
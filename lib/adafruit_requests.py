@@ -32,6 +32,10 @@ Implementation Notes
 """
 
 import errno
+import io
+import os
+import random
+import time
 
 
 def _buffer_split0(buf, needle):
@@ -52,7 +56,9 @@ class _RawResponse:
         """
         if size == -1:
             return self._response.content
-        return self._response.socket.recv(size)
+        buf = bytearray(size)
+        read = self._response._readinto(buf)  # pylint: disable=protected-access
+        return bytes(memoryview(buf)[:read])
 
     def readinto(self, buf):
         """Read as much as available into buf or until it is full. Returns the number of bytes read
@@ -60,6 +66,70 @@ class _RawResponse:
         return self._response._readinto(buf)  # pylint: disable=protected-access
 
 
+# headers Response and Session need, parsed even when filtering
+_REQUIRED_HEADERS = (
+    "content-length",
+    "transfer-encoding",
+    "connection",
+    "keep-alive",
+    "location",
+)
+
+# headers Session.download() relies on, kept by any filter as well
+_DOWNLOAD_HEADERS = ("content-range", "etag")
+
+
+class _BodyStream(io.IOBase):
+    """The undecoded body of a Response as a stream for the decompressor"""
+
+    def __init__(self, response):
+        self._response = response
+        self.failed = False  # the socket failed, not the decompressor
+
+    def readinto(self, buf):
+        """Read raw body bytes into 'buf'"""
+        try:
+            return self._response._read_body(buf)  # pylint: disable=protected-access
+        except Exception:
+            self.failed = True
+            raise
+
+
+def _decompressor(stream, encoding, wbits=15):
+    """A decoder with readinto() for a 'gzip' or 'deflate' body read from
+    'stream', None if we can't decode it. It allocates a window of 2**wbits
+    bytes for as long as the body lasts; a body compressed with a larger
+    window fails to decode"""
+    # pylint: disable=import-outside-toplevel
+    if encoding not in ("gzip", "deflate"):
+        return None
+    try:
+        import deflate
+
+        fmt = deflate.GZIP if encoding == "gzip" else deflate.ZLIB
+        return deflate.DeflateIO(stream, fmt, wbits)
+    except ImportError:
+        pass
+    try:
+        import uzlib
+    except ImportError:
+        return None
+    # uzlib reads the gzip header when asked for 16 + window bits
+    return uzlib.DecompIO(stream, 16 + wbits if encoding == "gzip" else wbits)
+
+
+def _can_decompress():
+    # pylint: disable=import-outside-toplevel, unused-import
+    try:
+        import deflate
+    except ImportError:
+        try:
+            import uzlib
+        except ImportError:
+            return False
+    return True
+
+
 class _SendFailed(Exception):
     """Custom exception to abort sending a request."""
 
@@ -68,29 +138,45 @@ class OutOfRetries(Exception):
     """Raised when requests has retried to make a request unsuccessfully."""
 
 
+class TooManyRedirects(Exception):
+    """Raised when a request is redirected more than the session allows."""
+
+
 class Response:
     """The response from a request, contains all the headers/content"""
 
     # pylint: disable=too-many-instance-attributes
 
     encoding = None
-
-    def __init__(self, sock, session=None):
+    from_cache = False
+    # set by Session.request: where this came from, how long it took from
+    # sending the request to the headers, and the redirects that led here
+    url = None
+    elapsed_ms = None
+    history = ()
+    timing = None
+
+    def __init__(self, sock, session=None, method=None):
         self.socket = sock
         self.encoding = "utf-8"
         self._cached = None
         self._headers = {}
 
-        # _start_index and _receive_buffer are used when parsing headers.
-        # _receive_buffer will grow by 32 bytes everytime it is too small.
+        # unread data lives in _receive_buffer[_received_start:_received_length].
+        # The buffer starts at the size the session's last headers needed and
+        # doubles whenever a single line doesn't fit.
+        self._received_start = 0
         self._received_length = 0
-        self._receive_buffer = bytearray(32)
+        self._receive_buffer = bytearray(session._receive_hint if session else 32)
+        self._header_filter = session._header_filter if session else None
         self._remaining = None
         self._chunked = False
 
         self._backwards_compatible = not hasattr(sock, "recv_into")
+        self._received_bytes = 0
 
         http = self._readto(b" ")
+        self._first_byte_at = time.ticks_ms()
         if not http:
             if session:
                 session._close_socket(self.socket)
@@ -100,8 +186,45 @@ class Response:
         self.status_code = int(bytes(self._readto(b" ")))
         self.reason = self._readto(b"\r\n")
         self._parse_headers()
+        self._headers_at = time.ticks_ms()
+        # these never have a body, whatever Content-Length says
+        bodyless = (
+            method == "HEAD"
+            or self.status_code < 200
+            or self.status_code in (204, 304)
+        )
+        if bodyless:
+            self._remaining = 0
+            self._chunked = False
         self._raw = None
         self._session = session
+        if session and len(self._receive_buffer) > session._receive_hint:
+            session._receive_hint = len(self._receive_buffer)
+        # bodies are decoded for callers, headers and Content-Length stay as sent
+        self._decoder = None
+        self._body_stream = None
+        content_encoding = self._headers.get("content-encoding")
+        if content_encoding and session and session._accept_encoding and not bodyless:
+            self._body_stream = _BodyStream(self)
+            self._decoder = _decompressor(
+                self._body_stream,
+                content_encoding.strip().lower(),
+                session._max_window_bits,
+            )
+        # HTTP/1.1 keeps the connection unless told otherwise, 1.0 the reverse
+        connection = self._headers.get("connection", "").lower()
+        if bytes(http) == b"HTTP/1.0":
+            self._keep_alive = "keep-alive" in connection
+        else:
+            self._keep_alive = "close" not in connection
+        if self._remaining is None and not self._chunked:
+            # the body only ends when the server closes the connection
+            self._keep_alive = False
+        self._keep_alive_timeout = None
+        for param in self._headers.get("keep-alive", "").split(","):
+            name, _, value = param.strip().partition("=")
+            if name == "timeout" and value.isdigit():
+                self._keep_alive_timeout = int(value)
 
     def __enter__(self):
         return self
@@ -115,8 +238,10 @@ class Response:
             b = self.socket.recv(size)
             read_size = len(b)
             buf[:read_size] = b
-            return read_size
-        return self.socket.recv_into(buf, size)
+        else:
+            read_size = self.socket.recv_into(buf, size)
+        self._received_bytes += read_size
+        return read_size
 
     @staticmethod
     def _find(buf, needle, start, end):
@@ -135,69 +260,96 @@ class Response:
 
         return result
 
-    def _readto(self, first, second=b""):
+    def _fill(self):
+        """Receive more data behind what's buffered, making room first by
+        moving the unread part to the front or, if that's all of the
+        buffer, by doubling it. Returns how much was read"""
         buf = self._receive_buffer
+        start = self._received_start
         end = self._received_length
+        if end == len(buf):
+            if start:
+                buf[: end - start] = memoryview(buf)[start:end]
+            else:
+                buf = bytearray(len(buf) * 2)
+                buf[:end] = self._receive_buffer
+                self._receive_buffer = buf
+            end -= start
+            self._received_start = 0
+            self._received_length = end
+        read = self._recv_into(memoryview(buf)[end:])
+        self._received_length += read
+        return read
+
+    def _consume(self, index):
+        """Drop the buffered data before 'index'"""
+        if index >= self._received_length:
+            self._received_start = self._received_length = 0
+        else:
+            self._received_start = index
+
+    def _scan_for(self, first, second=b""):
+        """Index of 'first' or 'second', whichever comes first, in the unread
+        data and its length, receiving more until one shows up. Index is -1
+        if the data ended first. Each pass only searches the new data"""
+        scan = 0  # relative to _received_start, which _fill() may move
+        overlap = max(len(first), len(second)) - 1
         while True:
-            firsti = self._find(buf, first, 0, end)
-            secondi = -1
+            buf = self._receive_buffer
+            start = self._received_start
+            end = self._received_length
+            i = self._find(buf, first, start + scan, end)
+            needle_len = len(first)
             if second:
-                secondi = self._find(buf, second, 0, end)
-
-            i = -1
-            needle_len = 0
-            if firsti >= 0:
-                i = firsti
-                needle_len = len(first)
-            if secondi >= 0 and (firsti < 0 or secondi < firsti):
-                i = secondi
-                needle_len = len(second)
+                j = self._find(buf, second, start + scan, end)
+                if j >= 0 and (i < 0 or j < i):
+                    i = j
+                    needle_len = len(second)
             if i >= 0:
-                result = buf[:i]
-                new_start = i + needle_len
-
-                if i + needle_len <= end:
-                    new_end = end - new_start
-                    buf[:new_end] = buf[new_start:end]
-                    self._received_length = new_end
-                return result
-
-            # Not found so load more.
-
-            # If our buffer is full, then make it bigger to load more.
-            if end == len(buf):
-                new_size = len(buf) + 32
-                new_buf = bytearray(new_size)
-                new_buf[: len(buf)] = buf
-                buf = new_buf
-                self._receive_buffer = buf
-
-            read = self._recv_into(memoryview(buf)[end:])
-            if read == 0:
-                self._received_length = 0
-                return buf[:end]
-            end += read
+                return i, needle_len
+            scan = max(0, end - start - overlap)
+            if not self._fill():
+                return -1, 0
 
-        return b""
+    def _readto(self, first, second=b""):
+        index, needle_len = self._scan_for(first, second)
+        buf = self._receive_buffer
+        start = self._received_start
+        if index < 0:
+            result = buf[start : self._received_length]
+            self._received_start = self._received_length = 0
+            return result
+        result = buf[start:index]
+        self._consume(index + needle_len)
+        return result
 
     def _read_from_buffer(self, buf=None, nbytes=None):
-        if self._received_length == 0:
+        start = self._received_start
+        read = self._received_length - start
+        if read == 0:
             return 0
-        read = self._received_length
         if nbytes < read:
             read = nbytes
-        membuf = memoryview(self._receive_buffer)
         if buf:
-            buf[:read] = membuf[:read]
-        if read < self._received_length:
-            new_end = self._received_length - read
-            self._receive_buffer[:new_end] = membuf[read : self._received_length]
-            self._received_length = new_end
-        else:
-            self._received_length = 0
+            buf[:read] = memoryview(self._receive_buffer)[start : start + read]
+        self._consume(start + read)
         return read
 
     def _readinto(self, buf):
+        if self._decoder:
+            try:
+                return self._decoder.readinto(buf)
+            except (OSError, ValueError) as error:
+                if self._body_stream.failed:
+                    raise
+                # pylint: disable=protected-access
+                raise RuntimeError(
+                    "Can't decode the body within max_window_bits=%d"
+                    % self._session._max_window_bits
+                ) from error
+        return self._read_body(buf)
+
+    def _read_body(self, buf):
         if not self.socket:
             raise RuntimeError(
                 "Newer Response closed this one. Use Responses immediately."
@@ -234,54 +386,103 @@ class Response:
         nbytes -= self._read_from_buffer(nbytes=nbytes)
 
         buf = self._receive_buffer
-        for _ in range(nbytes // len(buf)):
-            self._recv_into(buf)
-        remaining = nbytes % len(buf)
-        if remaining:
-            self._recv_into(buf, remaining)
+        while nbytes > 0:
+            # reads can come back short, count what we actually got
+            read = self._recv_into(buf, min(nbytes, len(buf)))
+            if not read:
+                break
+            nbytes -= read
 
     def close(self):
         """Drain the remaining WizFi360 socket buffers. We assume we already got what we wanted."""
         if not self.socket:
             return
         # Make sure we've read all of our response.
-        if self._cached is None:
-            if self._remaining and self._remaining > 0:
-                self._throw_away(self._remaining)
-            elif self._chunked:
-                while True:
-                    chunk_header = _buffer_split0(self._readto(b"\r\n"), b";")
-                    chunk_size = int(bytes(chunk_header), 16)
-                    if chunk_size == 0:
-                        break
-                    self._throw_away(chunk_size + 2)
-                self._parse_headers()
-        if self._session:
-            self._session._free_socket(self.socket)  # pylint: disable=protected-access
+        drained = True
+        try:
+            if self._cached is None:
+                if self._remaining and self._remaining > 0:
+                    self._throw_away(self._remaining)
+                    self._remaining = 0
+                if self._chunked:
+                    while True:
+                        if self._remaining == 0:
+                            self._throw_away(2)  # the CRLF behind the last chunk
+                        chunk_header = _buffer_split0(self._readto(b"\r\n"), b";")
+                        chunk_size = int(bytes(chunk_header), 16)
+                        if chunk_size == 0:
+                            break
+                        self._throw_away(chunk_size)
+                        self._remaining = 0
+                    self._chunked = False
+                    self._parse_headers()
+        except OSError:
+            drained = False  # timed out, the rest of the body may still come
+        if self._session and drained and self._keep_alive:
+            # pylint: disable=protected-access
+            self._session._free_socket(self.socket, self._keep_alive_timeout)
+        elif self._session:
+            self._session._close_socket(self.socket)  # pylint: disable=protected-access
         else:
             self.socket.close()
         self.socket = None
+        self._decoder = None
+        timing = self.timing
+        if timing is not None and timing["total_ms"] is None:
+            now = time.ticks_ms()
+            timing["body_ms"] = time.ticks_diff(now, self._headers_at)
+            timing["total_ms"] = time.ticks_diff(now, timing["start"])
+            timing["received"] = self._received_bytes
+            if self._session and self._session._timings is not None:
+                self._session._timings.add(timing)  # pylint: disable=protected-access
 
     def _parse_headers(self):
         """
         Parses the header portion of an HTTP request/response from the socket.
         Expects first line of HTTP request/response to have been read already.
+        Headers the session's keep_headers doesn't ask for are skipped in the
+        receive buffer, without making strings of them.
         """
         while True:
-            title = self._readto(b": ", b"\r\n")
-            if not title:
+            index, _ = self._scan_for(b"\r\n")
+            start = self._received_start
+            if index < 0:
+                self._received_start = self._received_length = 0
                 break
-
-            content = self._readto(b"\r\n")
-            if title and content:
+            if index == start:
+                self._consume(index + 2)
+                break
+            buf = self._receive_buffer
+            colon = self._find(buf, b":", start, index)
+            if colon > start and self._wanted_header(buf, start, colon):
                 # enforce that all headers are lowercase
-                title = str(title, "utf-8").lower()
-                content = str(content, "utf-8")
-                if title == "content-length":
-                    self._remaining = int(content)
-                if title == "transfer-encoding":
-                    self._chunked = content.strip().lower() == "chunked"
-                self._headers[title] = content
+                title = str(buf[start:colon], "utf-8").lower()
+                content = str(buf[colon + 1 : index], "utf-8").strip()
+                if content:
+                    if title == "content-length":
+                        self._remaining = int(content)
+                    if title == "transfer-encoding":
+                        self._chunked = content.lower() == "chunked"
+                    self._headers[title] = content
+            self._consume(index + 2)
+
+    def _wanted_header(self, buf, start, end):
+        """Whether the header named buf[start:end] passes the header filter,
+        compared in place and ignoring case"""
+        if self._header_filter is None:
+            return True
+        for name in self._header_filter.get(end - start, ()):
+            i = 0
+            while i < len(name):
+                byte = buf[start + i]
+                if 0x41 <= byte <= 0x5A:  # only A-Z are folded
+                    byte |= 0x20
+                if byte != name[i]:
+                    break
+                i += 1
+            if i == len(name):
+                return True
+        return False
 
     @property
     def headers(self):
@@ -337,6 +538,54 @@ class Response:
         self.close()
         return obj
 
+    def json_select(self, paths, buffer_size=256):
+        """Pull the values at 'paths' ("current.temp", "items[*].id") out of a
+        JSON body as it streams in, without building the whole document.
+        Returns a dict of path to value, None if it's missing and a list of
+        values for [*] paths"""
+        # pylint: disable=import-outside-toplevel
+        from adafruit_requests_json import select
+
+        if self._cached is not None:
+            raise RuntimeError("Cannot select json after getting text, content or json")
+        try:
+            return select(self._readinto, paths, buffer_size)
+        finally:
+            self.close()
+
+    def save_to(self, path, buffer_size=512, progress=None):
+        """Stream the body into the file at 'path' through one reusable buffer,
+        so memory use doesn't depend on the body size. 'progress' is called as
+        progress(received, total) after every write, total is None for
+        chunked and compressed bodies. Returns a dict with the bytes written, the time it
+        took in ms and the throughput in bytes/s"""
+        if self._cached is not None:
+            raise RuntimeError("Cannot save content after getting text, content or json")
+        total = None if self._chunked or self._decoder else self._remaining
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        received = 0
+        stamp = time.ticks_ms()
+        try:
+            with open(path, "wb") as file:
+                while True:
+                    size = self._readinto(buf)
+                    if size == 0:
+                        break
+                    file.write(view[:size])
+                    received += size
+                    if progress:
+                        progress(received, total)
+        finally:
+            # also when the file can't be written, the socket is needed again
+            self.close()
+        elapsed = time.ticks_diff(time.ticks_ms(), stamp)
+        return {
+            "bytes": received,
+            "ms": elapsed,
+            "bytes_per_s": received * 1000 // max(elapsed, 1),
+        }
+
     def iter_content(self, chunk_size=1, decode_unicode=False):
         """An iterator that will stream data by only reading 'chunk_size'
         bytes and yielding them, when we can't buffer the whole datastream"""
@@ -356,25 +605,1035 @@ class Response:
         self.close()
 
 
+class _CachedSocket:
+    """Plays a cached response back to Response: the stored status line and
+    headers from memory, then the body from its file"""
+
+    def __init__(self, head, body_path):
+        self._head = memoryview(head)
+        self._file = open(body_path, "rb")  # pylint: disable=consider-using-with
+
+    def settimeout(self, value):
+        """Nothing to wait for"""
+
+    def recv_into(self, buf, nbytes=0):
+        """Fill 'buf' from the header bytes, then from the body file"""
+        nbytes = nbytes or len(buf)
+        if self._head:
+            size = min(nbytes, len(self._head))
+            buf[:size] = self._head[:size]
+            self._head = self._head[size:]
+            return size
+        return self._file.readinto(memoryview(buf)[:nbytes])
+
+    def recv(self, num=0):
+        """recv_into() into a new bytes object"""
+        buf = bytearray(num or 64)
+        return bytes(buf[: self.recv_into(buf)])
+
+    def close(self):
+        """Close the body file"""
+        self._file.close()
+
+
+class HTTPCache:
+    """Keeps GET responses that carry an ETag or Last-Modified header on flash.
+    Later requests for the same URL are sent with If-None-Match and
+    If-Modified-Since, and a '304 Not Modified' is answered from the cache.
+    The least recently used responses go once the cache holds more than
+    'max_bytes' or 'max_entries'. Bodies above 'max_entry_bytes' aren't kept.
+    The index on flash is only rewritten when entries are added or removed,
+    so how recently they were used may be a little behind after a reset"""
+
+    # headers the cache reads, kept by Session even when filtering headers
+    HEADERS = ("etag", "last-modified", "cache-control")
+    _INDEX = "index.txt"
+    # hop-by-hop or rewritten headers we don't store
+    _SKIP = ("content-length", "transfer-encoding", "connection", "keep-alive")
+
+    def __init__(
+        self, directory="/http_cache", max_bytes=65536, max_entries=16, max_entry_bytes=None
+    ):
+        self._dir = directory.rstrip("/")
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_entry_bytes = max_entry_bytes or max_bytes
+        # url -> [file number, etag, last-modified, body size, last use]
+        self._entries = {}
+        self._clock = 0
+        self._next_file = 0
+        self._discard = None
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        try:
+            os.mkdir(self._dir)
+        except OSError:
+            pass  # it's already there
+        self._load()
+
+    @property
+    def hit_rate(self):
+        """Share of conditional requests answered from the cache"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def size(self):
+        """Bytes of bodies held"""
+        return sum(entry[3] for entry in self._entries.values())
+
+    def _path(self, number, ext):
+        return "%s/%d.%s" % (self._dir, number, ext)
+
+    def _load(self):
+        try:
+            with open(self._dir + "/" + self._INDEX, "r") as index:
+                for line in index:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != 6:
+                        continue
+                    number, size, use = int(fields[1]), int(fields[4]), int(fields[5])
+                    self._entries[fields[0]] = [number, fields[2], fields[3], size, use]
+                    self._clock = max(self._clock, use)
+                    self._next_file = max(self._next_file, number + 1)
+        except OSError:
+            pass  # no cache yet
+
+    def _save(self):
+        with open(self._dir + "/" + self._INDEX, "w") as index:
+            for url, entry in self._entries.items():
+                index.write("%s\t%d\t%s\t%s\t%d\t%d\n" % ((url,) + tuple(entry)))
+
+    def _remove(self, url):
+        self._remove_files(self._entries.pop(url)[0])
+
+    def _remove_files(self, number):
+        for ext in ("hdr", "bin"):
+            try:
+                os.remove(self._path(number, ext))
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self.max_entries or self.size > self.max_bytes
+        ):
+            oldest = min(self._entries, key=lambda url: self._entries[url][4])
+            self._remove(oldest)
+
+    def add_validators(self, url, headers):
+        """'headers' plus If-None-Match/If-Modified-Since for a cached 'url'"""
+        entry = self._entries.get(url)
+        if not entry:
+            return headers
+        headers = dict(headers)
+        if entry[1]:
+            headers["If-None-Match"] = entry[1]
+        if entry[2]:
+            headers["If-Modified-Since"] = entry[2]
+        return headers
+
+    def _replay(self, number):
+        with open(self._path(number, "hdr"), "rb") as head:
+            return Response(_CachedSocket(head.read(), self._path(number, "bin")))
+
+    def handle(self, url, resp):
+        """Answer a 304 from the cache or keep a cacheable 200, returns the
+        response to hand to the caller"""
+        if self._discard is not None:
+            self._remove_files(self._discard)
+            self._discard = None
+        entry = self._entries.get(url)
+        if resp.status_code == 304 and entry:
+            resp.close()
+            self.hits += 1
+            self.bytes_saved += entry[3]
+            # the LRU clock is written with the next change to the entries,
+            # not on every hit
+            self._clock += 1
+            entry[4] = self._clock
+            cached = self._replay(entry[0])
+            cached.from_cache = True
+            return cached
+        if entry:
+            # whatever came instead of a 304, the stored copy is out of date
+            self.misses += 1
+            self._remove(url)
+        headers = resp.headers
+        etag = headers.get("etag", "")
+        modified = headers.get("last-modified", "")
+        if (
+            resp.status_code != 200
+            or not (etag or modified)
+            or "no-store" in headers.get("cache-control", "")
+            or (resp._remaining or 0) > self.max_entry_bytes  # pylint: disable=protected-access
+        ):
+            if entry:
+                self._save()
+            return resp
+        number = self._next_file
+        self._next_file += 1
+        decoded = resp._decoder is not None  # pylint: disable=protected-access
+        size = resp.save_to(self._path(number, "bin"))["bytes"]
+        head = "HTTP/1.1 %d %s\r\n" % (resp.status_code, str(resp.reason, "utf-8"))
+        for name, value in headers.items():
+            if name not in self._SKIP and not (decoded and name == "content-encoding"):
+                head += "%s: %s\r\n" % (name, value)
+        head += "content-length: %d\r\n\r\n" % size
+        with open(self._path(number, "hdr"), "w") as file:
+            file.write(head)
+        if size > self.max_entry_bytes:
+            # a chunked body only shows its size once it's stored: hand it
+            # over anyway, but don't keep it
+            self._discard = number
+        else:
+            self._clock += 1
+            self._entries[url] = [number, etag, modified, size, self._clock]
+            self._evict()
+        self._save()
+        return self._replay(number)
+
+
+class _RequestBuffer:
+    """Collects a request in a preallocated buffer so it goes out in as few
+    socket.send() calls as possible. Pieces that don't fit are sent as is"""
+
+    def __init__(self, socket, buffer):
+        self._socket = socket
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._length = 0
+        self.sent = 0
+
+    def _send(self, data):
+        Session._send(self._socket, data)  # pylint: disable=protected-access
+        self.sent += len(data)
+
+    def write(self, data):
+        """Add str or bytes-like 'data' to the request"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        size = len(data)
+        if self._length + size > len(self._buffer):
+            self.flush()
+            if size > len(self._buffer):
+                self._send(data)
+                return
+        self._view[self._length : self._length + size] = data
+        self._length += size
+
+    def flush(self):
+        """Send whatever is buffered"""
+        if self._length:
+            self._send(self._view[: self._length])
+            self._length = 0
+
+    def write_from(self, readinto, size=None):
+        """Add up to 'size' bytes (all of them if None) read with
+        readinto(buffer) straight into the free part of the buffer"""
+        view = self._view
+        if not len(view):
+            view = memoryview(bytearray(256))  # unbuffered session
+        while size is None or size > 0:
+            if self._length == len(view):
+                self.flush()
+            free = len(view) - self._length
+            if size is not None:
+                free = min(free, size)
+            read = readinto(view[self._length : self._length + free])
+            if not read:
+                break
+            if view is self._view:
+                self._length += read
+            else:
+                self._send(view[:read])
+            if size is not None:
+                size -= read
+
+    def write_chunk(self, data):
+        """Add 'data' as one chunk of a chunked body, b"" ends the body"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.write(b"%x\r\n" % len(data))
+        if data:
+            self.write(data)
+        self.write(b"\r\n")
+
+
+def _is_file(data):
+    return hasattr(data, "readinto") or hasattr(data, "read")
+
+
+def _body_size(data):
+    """Length of a request body, None if it has to be sent chunked"""
+    if isinstance(data, (bytes, bytearray, memoryview)) or hasattr(data, "write_to"):
+        return len(data)
+    if _is_file(data):
+        try:
+            start = data.tell()
+            end = data.seek(0, 2)
+            data.seek(start)
+            return end - start
+        except (AttributeError, OSError):
+            return None
+    return None
+
+
+def _body_mark(data):
+    """Where a body starts, so a retried request can send it again. False if
+    it can't be sent twice"""
+    if isinstance(data, MultipartEncoder):
+        return data.mark()
+    if _is_file(data):
+        try:
+            return data.tell()
+        except (AttributeError, OSError):
+            return False
+    if isinstance(data, (bytes, bytearray, memoryview, str, dict, _JSONBody, _FormBody)) or data is None:
+        return True
+    return False  # an iterator can't be replayed
+
+
+def _rewind_body(data, mark):
+    if mark is False:
+        return False
+    if isinstance(data, MultipartEncoder):
+        data.rewind(mark)
+    elif mark is not True:
+        data.seek(mark)
+    return True
+
+
+def _write_body(out, data, size):
+    """Stream a request body through the request buffer"""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        out.write(data)
+    elif hasattr(data, "write_to"):
+        data.write_to(out)
+    elif size is not None:
+        if hasattr(data, "readinto"):
+            out.write_from(data.readinto, size)
+        else:
+            while size > 0:
+                piece = data.read(min(size, 512))
+                if not piece:
+                    break
+                out.write(piece)
+                size -= len(piece)
+    else:
+        if _is_file(data):
+            data = iter(lambda: data.read(512), b"")
+        for piece in data:
+            if piece:
+                out.write_chunk(piece)
+        out.write_chunk(b"")
+
+
+class _JSONBody:
+    """A json= request body, encoded piece by piece into the send buffer.
+    Its length takes a first pass that only counts"""
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __len__(self):
+        size = 0
+
+        def count(piece):
+            nonlocal size
+            size += len(piece.encode("utf-8")) if isinstance(piece, str) else len(piece)
+
+        _dump_json(self._obj, count)
+        return size
+
+    def write_to(self, out):
+        """Stream the document into a request buffer"""
+        _dump_json(self._obj, out.write)
+
+
+def _dump_json(obj, write):
+    """json.dumps(obj) handed to write() in pieces"""
+    # pylint: disable=import-outside-toplevel
+    try:
+        import json as json_module
+    except ImportError:
+        import ujson as json_module
+    _dump_json_value(obj, write, json_module.dumps)
+
+
+def _dump_json_value(obj, write, dumps):
+    if isinstance(obj, dict):
+        write(b"{")
+        first = True
+        for key in obj:
+            if not first:
+                write(b", ")
+            first = False
+            write(dumps(key if isinstance(key, str) else str(key)))
+            write(b": ")
+            _dump_json_value(obj[key], write, dumps)
+        write(b"}")
+    elif isinstance(obj, (list, tuple)):
+        write(b"[")
+        for i, item in enumerate(obj):
+            if i:
+                write(b", ")
+            _dump_json_value(item, write, dumps)
+        write(b"]")
+    else:
+        write(dumps(obj))
+
+
+# bytes that go into a query or form as they are, the rest are %XX escaped
+_URL_SAFE = bytearray(256)
+for _byte in b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~":
+    _URL_SAFE[_byte] = 1
+del _byte
+_HEX = b"0123456789ABCDEF"
+
+
+def _write_escaped(value, write):
+    """Percent-escape 'value' for a query or form, spaces as '+', handing
+    runs of bytes that need no escaping to write() in one piece"""
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+    elif isinstance(value, (bytes, bytearray)):
+        data = value
+    else:
+        data = str(value).encode("utf-8")
+    view = memoryview(data)
+    safe = _URL_SAFE
+    start = 0
+    escape = bytearray(b"%00")
+    for i, byte in enumerate(data):
+        if safe[byte]:
+            continue
+        if i > start:
+            write(view[start:i])
+        if byte == 0x20:
+            write(b"+")
+        else:
+            escape[1] = _HEX[byte >> 4]
+            escape[2] = _HEX[byte & 0xF]
+            write(escape)
+        start = i + 1
+    if start < len(data):
+        write(view[start:])
+
+
+def _escaped_size(value):
+    """Length of 'value' once _write_escaped() is done with it"""
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+    elif isinstance(value, (bytes, bytearray)):
+        data = value
+    else:
+        data = str(value).encode("utf-8")
+    size = len(data)
+    safe = _URL_SAFE
+    for byte in data:
+        if not safe[byte] and byte != 0x20:
+            size += 2
+    return size
+
+
+def _form_items(fields):
+    """(key, value) pairs of a form, list values repeating their key"""
+    items = fields.items() if isinstance(fields, dict) else fields
+    for key, value in items:
+        if isinstance(value, (list, tuple)):
+            for item in value:
+                yield key, item
+        else:
+            yield key, value
+
+
+def _write_form(fields, write):
+    """key=value pairs of a dict, or of a list of (key, value), escaped and
+    joined with '&'. A list or tuple value repeats the key for each item"""
+    first = True
+    for key, value in _form_items(fields):
+        if not first:
+            write(b"&")
+        first = False
+        _write_escaped(key, write)
+        write(b"=")
+        _write_escaped(value, write)
+
+
+def urlencode(fields):
+    """Encode a dict or a list of (key, value) pairs as a query string"""
+    out = bytearray()
+    _write_form(fields, out.extend)
+    return str(out, "utf-8")
+
+
+def _escape_path(path):
+    """Escape what can't appear in a request line at all: spaces, control
+    and non-ASCII characters. Anything else is taken as already encoded"""
+    for char in path:
+        if char <= " " or char > "~" or char in '"<>':
+            break
+    else:
+        return path
+    out = bytearray()
+    for byte in path.encode("utf-8"):
+        if byte <= 0x20 or byte >= 0x7F or byte in b'"<>':
+            out.extend((0x25, _HEX[byte >> 4], _HEX[byte & 0xF]))
+        else:
+            out.append(byte)
+    return str(out, "utf-8")
+
+
+class _FormBody:
+    """A data=dict request body, escaped straight into the send buffer. Its
+    length is counted without escaping anything"""
+
+    def __init__(self, fields):
+        self._fields = fields
+
+    def __len__(self):
+        size = -1  # no '&' in front of the first pair
+        for key, value in _form_items(self._fields):
+            size += _escaped_size(key) + 1 + _escaped_size(value) + 1
+        return max(size, 0)
+
+    def write_to(self, out):
+        """Stream the form into a request buffer"""
+        _write_form(self._fields, out.write)
+
+
+class MultipartEncoder:
+    """A multipart/form-data request body that is streamed, not built in
+    memory. 'fields' maps names to str or bytes values, or to (filename,
+    file or bytes, content type) tuples for uploads. Pass it as 'data'"""
+
+    def __init__(self, fields, boundary=None):
+        if boundary is None:
+            boundary = "wizfi360-%08x%08x" % (
+                random.getrandbits(32),
+                random.getrandbits(32),
+            )
+        self.boundary = boundary
+        self.content_type = "multipart/form-data; boundary=" + boundary
+        # (part header, content) per field
+        self._parts = []
+        for name in fields:
+            value = fields[name]
+            head = '--%s\r\nContent-Disposition: form-data; name="%s"' % (boundary, name)
+            if isinstance(value, tuple):
+                filename, value, content_type = value
+                head += '; filename="%s"\r\nContent-Type: %s' % (filename, content_type)
+            if isinstance(value, str):
+                value = value.encode("utf-8")
+            self._parts.append(((head + "\r\n\r\n").encode("utf-8"), value))
+        self._end = ("--%s--\r\n" % boundary).encode("utf-8")
+
+    def __len__(self):
+        size = len(self._end)
+        for head, value in self._parts:
+            value_size = _body_size(value)
+            if value_size is None:
+                raise ValueError("Multipart files must be seekable")
+            size += len(head) + value_size + 2
+        return size
+
+    def mark(self):
+        """Positions of the files in the body"""
+        return [value.tell() if _is_file(value) else None for _, value in self._parts]
+
+    def rewind(self, marks):
+        """Go back to the positions mark() returned"""
+        for (_, value), position in zip(self._parts, marks):
+            if position is not None:
+                value.seek(position)
+
+    def write_to(self, out):
+        """Stream the body into a request buffer"""
+        for head, value in self._parts:
+            out.write(head)
+            _write_body(out, value, _body_size(value))
+            out.write(b"\r\n")
+        out.write(self._end)
+
+
+def _parse_content_range(value):
+    """'bytes 100-199/1000' -> (100, 199, 1000), total None for '*'"""
+    try:
+        unit, _, spec = value.strip().partition(" ")
+        span, _, total = spec.partition("/")
+        start, _, end = span.partition("-")
+        if unit != "bytes":
+            raise ValueError(value)
+        return int(start), int(end), None if total == "*" else int(total)
+    except ValueError as error:
+        raise RuntimeError("Bad Content-Range: " + value) from error
+
+
+def _file_size(path):
+    try:
+        return os.stat(path)[6]
+    except OSError:
+        return 0
+
+
+class _RangeFetch:
+    """One resumable byte range of a download, kept in its own file. step()
+    moves it on by a buffer at a time so several can be interleaved; failed
+    requests are retried with growing delays, from where the file ends"""
+
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self, session, url, path, headers, retry, start=0, end=None, etag=None):
+        self._session = session
+        self._url = url
+        self._path = path
+        self._headers = headers or {}
+        self._retries, self._backoff_ms, self._max_backoff_ms = retry
+        self._first = start
+        self._end = end  # inclusive, None for up to the end
+        self.etag = etag
+        self.total = None
+        self.failures = 0
+        self.done = False
+        self._response = None
+        self._file = None
+        self._retry_at = None
+        # without a validator we can't tell a partial file is still current
+        self.received = _file_size(path) if etag else 0
+        self.resumed_from = self.received
+
+    @property
+    def expected(self):
+        """Bytes this range should end up with, None if unknown"""
+        if self._end is not None:
+            return self._end - self._first + 1
+        if self.total is not None:
+            return self.total - self._first
+        return None
+
+    def _open(self):
+        # only what's there under a known ETag is worth keeping
+        resuming = bool(self.received and self.etag)
+        if not resuming:
+            self.received = 0
+        offset = self._first + self.received
+        headers = dict(self._headers)
+        headers["Range"] = "bytes=%d-%s" % (offset, "" if self._end is None else self._end)
+        # offsets count the bytes as sent, the file holds them decoded
+        headers["Accept-Encoding"] = "identity"
+        if resuming:
+            headers["If-Range"] = self.etag
+        resp = self._session.get(self._url, headers=headers, stream=True)
+        mode = "ab" if resuming else "wb"
+        if resp.status_code == 206:
+            start, _, self.total = _parse_content_range(resp.headers.get("content-range", ""))
+            if start != offset:
+                resp.close()
+                raise RuntimeError("Server sent the wrong range")
+            if resuming and resp.headers.get("etag", self.etag) != self.etag:
+                resp.close()
+                self.received = 0
+                raise RuntimeError("File changed on the server")
+        elif resp.status_code == 416 and self.received:
+            resp.close()
+            self.done = True  # nothing left to send
+            return
+        elif resp.status_code == 200 and self._first == 0:
+            # range not supported or the file changed: start over
+            self.received = 0
+            self.total = resp._remaining  # pylint: disable=protected-access
+            mode = "wb"
+        else:
+            resp.close()
+            raise RuntimeError("Download failed with status %d" % resp.status_code)
+        etag = resp.headers.get("etag")
+        if etag:
+            self.etag = etag
+        self._response = resp
+        self._file = open(self._path, mode)  # pylint: disable=consider-using-with
+
+    def _close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self._response:
+            try:
+                self._response.close()
+            except (OSError, RuntimeError):
+                pass
+            self._response = None
+
+    def _fail(self, error):
+        self._close()
+        self.failures += 1
+        if self.failures > self._retries:
+            raise error
+        delay = min(self._backoff_ms << (self.failures - 1), self._max_backoff_ms)
+        self._retry_at = time.ticks_add(time.ticks_ms(), delay)
+
+    def step(self, buf):
+        """Read one buffer of the range into its file, False once complete"""
+        if self.done:
+            return False
+        if self._response is None:
+            if self._retry_at is not None:
+                if time.ticks_diff(self._retry_at, time.ticks_ms()) > 0:
+                    return True  # still backing off
+                self._retry_at = None
+            try:
+                self._open()
+            except (OSError, RuntimeError) as error:
+                self._fail(error)
+                return True
+            if self.done:
+                return False
+        try:
+            # pylint: disable=protected-access
+            size = self._response._readinto(buf)
+        except (OSError, RuntimeError) as error:
+            self._fail(error)
+            return True
+        if size:
+            self._file.write(memoryview(buf)[:size])
+            self.received += size
+            return True
+        self._close()
+        expected = self.expected
+        if expected is not None and self.received < expected:
+            self._fail(RuntimeError("Download ended early"))
+            return True
+        self.done = True
+        return False
+
+
+def _run_fetches(fetches, buffer_size, progress):
+    """Interleave the fetches until all are complete, returns the stats"""
+    buf = bytearray(buffer_size)
+    stamp = time.ticks_ms()
+    active = list(fetches)
+    while active:
+        active = [fetch for fetch in active if fetch.step(buf)]
+        if progress:
+            received = sum(fetch.received for fetch in fetches)
+            expected = [fetch.expected for fetch in fetches]
+            progress(received, None if None in expected else sum(expected))
+    elapsed = time.ticks_diff(time.ticks_ms(), stamp)
+    received = sum(fetch.received for fetch in fetches)
+    resumed = sum(fetch.resumed_from for fetch in fetches)
+    return {
+        "bytes": received,
+        "resumed_from": resumed,
+        "retries": sum(fetch.failures for fetch in fetches),
+        "ms": elapsed,
+        "bytes_per_s": (received - resumed) * 1000 // max(elapsed, 1),
+    }
+
+
+def _read_etag(path):
+    try:
+        with open(path + ".etag", "r") as file:
+            return file.read().strip() or None
+    except OSError:
+        return None
+
+
+def _write_etag(path, etag):
+    if etag:
+        with open(path + ".etag", "w") as file:
+            file.write(etag)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _split_url(url):
+    """'https://host:8080/a/b?c' -> ('https:', 'host', 8080, 'a/b?c')"""
+    try:
+        proto, dummy, host, path = url.split("/", 3)
+        path = _escape_path(path)
+    except ValueError:
+        proto, dummy, host = url.split("/", 2)
+        path = ""
+    if proto == "http:":
+        port = 80
+    elif proto == "https:":
+        port = 443
+    else:
+        raise ValueError("Unsupported protocol: " + proto)
+
+    if ":" in host:
+        host, port = host.split(":", 1)
+        port = int(port)
+    return proto, host, port, path
+
+
+def _join_url(url, location):
+    """Where a Location header points, seen from 'url'"""
+    if location.startswith("http:") or location.startswith("https:"):
+        return location
+    parts = url.split("/", 3)
+    proto, origin = parts[0], parts[2]
+    if location.startswith("//"):
+        return proto + location
+    if location.startswith("/"):
+        return proto + "//" + origin + location
+    # relative path: resolved against the directory of the current one
+    path = parts[3] if len(parts) > 3 else ""
+    parts = path.split("?", 1)[0].split("/")[:-1]
+    for part in location.split("/"):
+        if part == "..":
+            if parts:
+                parts.pop()
+        elif part != ".":
+            parts.append(part)
+    return proto + "//" + origin + "/" + "/".join(parts)
+
+
+def _new_timing(start):
+    """The timing record of one request: ms spent in each phase, the bytes
+    each way, the attempts that had to be repeated and whether a kept-alive
+    connection was used. 'start' is its time.ticks_ms(). body_ms, total_ms
+    and received are filled in when the response is closed"""
+    return {
+        "start": start,
+        "dns_ms": 0,
+        "connect_ms": 0,
+        "send_ms": 0,
+        "first_byte_ms": None,
+        "headers_ms": None,
+        "body_ms": None,
+        "total_ms": None,
+        "sent": 0,
+        "received": None,
+        "retries": 0,
+        "reused": False,
+    }
+
+
+class TimingStats:
+    """Collects the timing of the last 'max_samples' requests of a Session,
+    given to it as 'timings', and reports percentiles for each phase. The
+    TLS handshake is part of connect_ms, the WizFi360 does it in AT+CIPSTART"""
+
+    PHASES = (
+        "dns_ms",
+        "connect_ms",
+        "send_ms",
+        "first_byte_ms",
+        "headers_ms",
+        "body_ms",
+        "total_ms",
+    )
+
+    def __init__(self, max_samples=64):
+        self._max_samples = max_samples
+        self._samples = {phase: [] for phase in self.PHASES}
+        self._next = 0
+        self.count = 0
+        self.retries = 0
+        self.reused = 0
+
+    def add(self, timing):
+        """Record the timing dict of a finished request"""
+        for phase in self.PHASES:
+            samples = self._samples[phase]
+            value = timing[phase] or 0
+            if len(samples) < self._max_samples:
+                samples.append(value)
+            else:
+                samples[self._next] = value
+        self._next = (self._next + 1) % self._max_samples
+        self.count += 1
+        self.retries += timing["retries"]
+        if timing["reused"]:
+            self.reused += 1
+
+    def percentile(self, phase, percent):
+        """The 'percent' percentile of 'phase' in ms, None with no samples"""
+        samples = sorted(self._samples[phase])
+        if not samples:
+            return None
+        index = (len(samples) * percent + 99) // 100 - 1
+        return samples[min(max(index, 0), len(samples) - 1)]
+
+    def report(self, percents=(50, 90, 99)):
+        """{phase: {percent: ms}} for every phase"""
+        return {
+            phase: {percent: self.percentile(phase, percent) for percent in percents}
+            for phase in self.PHASES
+        }
+
+    def reset(self):
+        """Forget everything collected so far"""
+        for phase in self.PHASES:
+            self._samples[phase] = []
+        self._next = 0
+        self.count = self.retries = self.reused = 0
+
+
+class PreparedRequest:
+    """A request whose URL is parsed and whose request line and headers are
+    encoded once, from Session.prepare(). send(body) only adds the length
+    and the body, for the same POST made again and again. Redirects aren't
+    followed and the session's cache isn't used"""
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, session, method, url, headers=None):
+        if not headers:
+            headers = {}
+        proto, host, port, path = _split_url(url)
+        self._session = session
+        self._key = (host, port, proto)
+        self._method = method
+        self.url = url
+        head = [method, " /", path, " HTTP/1.1\r\n"]
+        if "Host" not in headers:
+            head += ["Host: ", host, "\r\n"]
+        if "User-Agent" not in headers:
+            head.append("User-Agent: Adafruit CircuitPython\r\n")
+        # pylint: disable=protected-access
+        if session._accept_encoding and "Accept-Encoding" not in headers:
+            head.append("Accept-Encoding: gzip, deflate\r\n")
+        for k in headers:
+            head += [k, ": ", headers[k], "\r\n"]
+        self._head = "".join(head).encode("utf-8")
+        self._body = None
+        self._write = self._write_request
+
+    def _write_request(self, socket):
+        body = self._body
+        out = _RequestBuffer(socket, self._session._send_buffer)  # pylint: disable=protected-access
+        out.write(self._head)
+        size = None if body is None else _body_size(body)
+        if body is None:
+            out.write(b"\r\n")
+        elif size is None:
+            out.write(b"Transfer-Encoding: chunked\r\n\r\n")
+        else:
+            out.write(b"Content-Length: %d\r\n\r\n" % size)
+        if body is not None:
+            _write_body(out, body, size)
+        out.flush()
+        return out.sent
+
+    def send(self, body=None, timeout=60):
+        """Send the request with 'body' (bytes, str, or anything 'data' takes
+        apart from a dict) and return the Response"""
+        if isinstance(body, dict):
+            # the headers are fixed, so there's no Content-Type to go with
+            # a form or a JSON document here
+            raise TypeError("Encode dict bodies first, e.g. with urlencode()")
+        session = self._session
+        # pylint: disable=protected-access
+        if session._last_response:
+            session._last_response.close()
+            session._last_response = None
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self._body = body
+        try:
+            host, port, proto = self._key
+            resp = session._exchange(self._method, host, port, proto, body, self._write, timeout)
+        finally:
+            self._body = None
+        resp.url = self.url
+        session._last_response = resp
+        return resp
+
+
 class Session:
-    """HTTP session that shares sockets and ssl context."""
+    """HTTP session that shares sockets and ssl context. Connections are kept
+    open between requests to the same host unless the server closes them;
+    an idle one is only trusted for 'idle_timeout' seconds, or what the
+    server's Keep-Alive header says. Pass a list of header names as
+    'keep_headers' to parse only those (plus the ones needed internally).
+    Give it an HTTPCache as 'cache' to revalidate GETs instead of fetching
+    the same body again. With 'decompress', and a deflate or uzlib module
+    around, gzip and deflate bodies are asked for and decoded as they're read,
+    with a window of 2**max_window_bits bytes (8 to 15). A body that needs a
+    larger one raises RuntimeError, lower it only for servers known to
+    compress with a small window.
+    Up to 'max_redirects' redirects are followed per request, on the same
+    connection when they stay on the same host. Every Response has a
+    'timing' dict, completed when it's closed; a TimingStats as 'timings'
+    collects them for percentiles"""
 
-    def __init__(self, socket_pool, ssl_context=None):
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        socket_pool,
+        ssl_context=None,
+        send_buffer_size=512,
+        idle_timeout=5,
+        keep_headers=None,
+        cache=None,
+        decompress=True,
+        max_redirects=10,
+        timings=None,
+        max_window_bits=15,
+    ):
         self._socket_pool = socket_pool
+        self._send_buffer = bytearray(send_buffer_size)
+        if ssl_context is None and hasattr(socket_pool, "iface"):
+            # a SocketPool knows its WizFi360, which does the TLS for us
+            ssl_context = _FakeSSLContext(socket_pool.iface)
         self._ssl_context = ssl_context
         # Hang onto open sockets so that we can reuse them.
         self._open_sockets = {}
         self._socket_free = {}
+        self._socket_expiry = {}
+        self._idle_timeout = idle_timeout
+        self._max_redirects = max_redirects
+        self._timings = timings
+        self._redirect_drain_limit = 1024
         self._last_response = None
-
-    def _free_socket(self, socket):
+        self._receive_hint = 32
+        self._cache = cache
+        if not 8 <= max_window_bits <= 15:
+            raise ValueError("max_window_bits must be 8 to 15")
+        self._max_window_bits = max_window_bits
+        self._accept_encoding = decompress and _can_decompress()
+        self._header_filter = None
+        if keep_headers is not None:
+            # header names by length, the ones we rely on always included
+            self._header_filter = {}
+            wanted = _REQUIRED_HEADERS + _DOWNLOAD_HEADERS + ("content-encoding",)
+            wanted += tuple(keep_headers)
+            if cache:
+                wanted += cache.HEADERS
+            for name in wanted:
+                name = name.lower().encode()
+                names = self._header_filter.setdefault(len(name), [])
+                if name not in names:
+                    names.append(name)
+
+    def _free_socket(self, socket, idle_timeout=None):
         if socket not in self._open_sockets.values():
             raise RuntimeError("Socket not from session")
         self._socket_free[socket] = True
+        if idle_timeout is None:
+            idle_timeout = self._idle_timeout
+        self._socket_expiry[socket] = time.ticks_add(
+            time.ticks_ms(), int(idle_timeout * 1000)
+        )
+
+    def _socket_usable(self, sock):
+        """A free socket is worth reusing if the server shouldn't have timed
+        it out yet and, where the socket can tell, the link is still up"""
+        expiry = self._socket_expiry.get(sock)
+        if expiry is not None and time.ticks_diff(expiry, time.ticks_ms()) <= 0:
+            return False
+        return getattr(sock, "connected", True)
 
     def _close_socket(self, sock):
         sock.close()
         del self._socket_free[sock]
+        self._socket_expiry.pop(sock, None)
         key = None
         for k in self._open_sockets:
             if self._open_sockets[k] == sock:
@@ -391,21 +1650,32 @@ class Session:
         for sock in free_sockets:
             self._close_socket(sock)
 
-    def _get_socket(self, host, port, proto, *, timeout=1):
-        # pylint: disable=too-many-branches
+    def _get_socket(self, host, port, proto, *, timeout=1, timing=None):
+        # pylint: disable=too-many-branches, too-many-statements
         key = (host, port, proto)
         if key in self._open_sockets:
             sock = self._open_sockets[key]
             if self._socket_free[sock]:
-                self._socket_free[sock] = False
-                return sock
+                if self._socket_usable(sock):
+                    self._socket_free[sock] = False
+                    sock.settimeout(timeout)
+                    if timing:
+                        timing["reused"] = True
+                    return sock
+                self._close_socket(sock)
+        if len(self._open_sockets) >= getattr(self._socket_pool, "MAX_SOCKETS", 0) > 0:
+            # a new connection would knock out an open one, close those we
+            # aren't using ourselves so they don't go stale in the cache
+            self._free_sockets()
         if proto == "https:" and not self._ssl_context:
             raise RuntimeError(
                 "ssl_context must be set before using adafruit_requests for https"
             )
+        stamp = time.ticks_ms()
         addr_info = self._socket_pool.getaddrinfo(
             host, port, 0, self._socket_pool.SOCK_STREAM
         )[0]
+        resolved = time.ticks_ms()
         retry_count = 0
         sock = None
         while retry_count < 5 and sock is None:
@@ -438,6 +1708,12 @@ class Session:
                 sock.close()
                 sock = None
 
+        if timing:
+            # the WizFi360 does the TLS handshake as part of connecting
+            timing["dns_ms"] += time.ticks_diff(resolved, stamp)
+            timing["connect_ms"] += time.ticks_diff(time.ticks_ms(), resolved)
+            timing["retries"] += retry_count - 1
+            timing["reused"] = False
         if sock is None:
             raise RuntimeError("Repeated socket failures")
 
@@ -462,141 +1738,342 @@ class Session:
 
     def _send_request(self, socket, host, method, path, headers, data, json):
         # pylint: disable=too-many-arguments
-        self._send(socket, bytes(method, "utf-8"))
-        self._send(socket, b" /")
-        self._send(socket, bytes(path, "utf-8"))
-        self._send(socket, b" HTTP/1.1\r\n")
+        # every socket.send() is a CIPSEND round trip on the WizFi360, so the
+        # request is put together in one buffer and sent in a single write
+        out = _RequestBuffer(socket, self._send_buffer)
+        out.write(method)
+        out.write(b" /")
+        out.write(path)
+        out.write(b" HTTP/1.1\r\n")
         if "Host" not in headers:
-            self._send(socket, b"Host: ")
-            self._send(socket, bytes(host, "utf-8"))
-            self._send(socket, b"\r\n")
+            out.write(b"Host: ")
+            out.write(host)
+            out.write(b"\r\n")
         if "User-Agent" not in headers:
-            self._send(socket, b"User-Agent: Adafruit CircuitPython\r\n")
+            out.write(b"User-Agent: Adafruit CircuitPython\r\n")
+        if self._accept_encoding and "Accept-Encoding" not in headers:
+            out.write(b"Accept-Encoding: gzip, deflate\r\n")
         # Iterate over keys to avoid tuple alloc
         for k in headers:
-            self._send(socket, k.encode())
-            self._send(socket, b": ")
-            self._send(socket, headers[k].encode())
-            self._send(socket, b"\r\n")
+            out.write(k)
+            out.write(b": ")
+            out.write(headers[k])
+            out.write(b"\r\n")
         if json is not None:
             assert data is None
-            # pylint: disable=import-outside-toplevel
-            try:
-                import json as json_module
-            except ImportError:
-                import ujson as json_module
-            data = json_module.dumps(json)
-            self._send(socket, b"Content-Type: application/json\r\n")
-        if data:
+            # encoded straight into the send buffer, never as one string
+            data = _JSONBody(json)
+            out.write(b"Content-Type: application/json\r\n")
+        # a json= or form body's length takes a pass over it, so it's only
+        # asked for once
+        size = None
+        if data is not None:
             if isinstance(data, dict):
-                self._send(
-                    socket, b"Content-Type: application/x-www-form-urlencoded\r\n"
-                )
-                _post_data = ""
-                for k in data:
-                    _post_data = "{}&{}={}".format(_post_data, k, data[k])
-                data = _post_data[1:]
-            self._send(socket, b"Content-Length: %d\r\n" % len(data))
-        self._send(socket, b"\r\n")
-        if data:
-            if isinstance(data, bytearray):
-                self._send(socket, bytes(data))
+                out.write(b"Content-Type: application/x-www-form-urlencoded\r\n")
+                data = _FormBody(data)
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            if isinstance(data, MultipartEncoder) and "Content-Type" not in headers:
+                out.write(b"Content-Type: ")
+                out.write(data.content_type)
+                out.write(b"\r\n")
+            # files and iterators are streamed, the latter chunked
+            size = _body_size(data)
+            if size is None:
+                out.write(b"Transfer-Encoding: chunked\r\n")
             else:
-                self._send(socket, bytes(data, "utf-8"))
+                out.write(b"Content-Length: %d\r\n" % size)
+        out.write(b"\r\n")
+        if data is not None:
+            _write_body(out, data, size)
+        out.flush()
+        return out.sent
+
+    def _request_once(self, method, url, data, json, headers, timeout):
+        # pylint: disable=too-many-arguments
+        proto, host, port, path = _split_url(url)
+
+        cache = self._cache if method == "GET" else None
+        if cache:
+            headers = cache.add_validators(url, headers)
+
+        def send(socket):
+            return self._send_request(socket, host, method, path, headers, data, json)
+
+        resp = self._exchange(method, host, port, proto, data, send, timeout)
+        if cache:
+            # a 304 is closed in there, that's not the end of this request
+            timing = resp.timing
+            resp.timing = None
+            resp = cache.handle(url, resp)
+            resp.timing = timing
+        resp.url = url
+        return resp
 
-    # pylint: disable=too-many-branches, too-many-statements, unused-argument, too-many-arguments, too-many-locals
+    def _exchange(self, method, host, port, proto, data, send, timeout):
+        """send(socket) the request and read the response headers"""
+        # pylint: disable=too-many-arguments
+        # A kept-alive socket may have been closed by the server in the meantime, which only
+        # shows when sending fails or no response comes back. So, try a second time in that case,
+        # if the body can be sent again.
+        resp = None
+        retry_count = 0
+        mark = _body_mark(data)
+        stamp = time.ticks_ms()
+        timing = _new_timing(stamp)
+        while retry_count < 2 and resp is None:
+            retry_count += 1
+            if retry_count > 1:
+                if not _rewind_body(data, mark):
+                    break
+                timing["retries"] += 1
+            socket = self._get_socket(host, port, proto, timeout=timeout, timing=timing)
+            try:
+                sending = time.ticks_ms()
+                timing["sent"] += send(socket)
+                sent = time.ticks_ms()
+                timing["send_ms"] += time.ticks_diff(sent, sending)
+                resp = Response(socket, self, method)  # our response
+            except (_SendFailed, OSError, RuntimeError):
+                if socket in self._socket_free:
+                    self._close_socket(socket)
+
+        if resp is None:
+            raise OutOfRetries("Repeated socket failures")
+        # pylint: disable=protected-access
+        timing["first_byte_ms"] = time.ticks_diff(resp._first_byte_at, sent)
+        timing["headers_ms"] = time.ticks_diff(resp._headers_at, resp._first_byte_at)
+        resp.timing = timing
+        resp.elapsed_ms = time.ticks_diff(resp._headers_at, stamp)
+        return resp
+
+    def _leave_redirect(self, resp):
+        """Done with a redirect: a short body is read off so the socket can
+        carry the next hop, a long one isn't worth it and the link is shut"""
+        # pylint: disable=protected-access
+        if resp.socket and resp._remaining and resp._remaining > self._redirect_drain_limit:
+            self._close_socket(resp.socket)
+            resp.socket = None
+        resp.close()
+
+    # pylint: disable=too-many-branches, unused-argument, too-many-arguments
     def request(
-        self, method, url, data=None, json=None, headers=None, stream=False, timeout=60
+        self,
+        method,
+        url,
+        data=None,
+        json=None,
+        headers=None,
+        stream=False,
+        timeout=60,
+        params=None,
     ):
         """Perform an HTTP request to the given url which we will parse to determine
         whether to use SSL ('https://') or not. We can also send some provided 'data'
-        or a json dictionary which we will stringify. 'headers' is optional HTTP headers
+        or a json dictionary which we will stringify. 'data' may also be a file, an iterator
+        of bytes (sent chunked) or a MultipartEncoder, which are streamed from one buffer
+        instead of being loaded. 'headers' is optional HTTP headers
         sent along. 'stream' will determine if we buffer everything, or whether to only
-        read only when requested
+        read only when requested. 'params', a dict or list of pairs, is added
+        to the url as an escaped query string. Redirects are followed up to the session's
+        'max_redirects', the responses passed on the way are in the final
+        one's 'history', each with its 'url' and 'elapsed_ms'
         """
         if not headers:
             headers = {}
+        if params:
+            url = url + ("&" if "?" in url else "?") + urlencode(params)
 
-        try:
-            print("request >>", url)
-            proto, dummy, host, path = url.split("/", 3)
-            # replace spaces in path
-            path = path.replace(" ", "%20")
-        except ValueError:
-            proto, dummy, host = url.split("/", 2)
-            path = ""
-        if proto == "http:":
-            port = 80
-        elif proto == "https:":
-            port = 443
-        else:
-            raise ValueError("Unsupported protocol: " + proto)
-
-        if ":" in host:
-            host, port = host.split(":", 1)
-            port = int(port)
-
+        print("request >>", url)
         if self._last_response:
             self._last_response.close()
             self._last_response = None
 
-        # We may fail to send the request if the socket we got is closed already. So, try a second
-        # time in that case.
-        retry_count = 0
-        while retry_count < 2:
-            retry_count += 1
-            socket = self._get_socket(host, port, proto, timeout=timeout)
-            ok = True
-            try:
-                self._send_request(socket, host, method, path, headers, data, json)
-            except (_SendFailed, OSError):
-                ok = False
-            if ok:
-                # Read the H of "HTTP/1.1" to make sure the socket is alive. send can appear to work
-                # even when the socket is closed.
-                if hasattr(socket, "recv"):
-                    result = socket.recv(1)
-                else:
-                    result = bytearray(1)
-                    try:
-                        socket.recv_into(result)
-                    except OSError:
-                        pass
-                if result == b"H":
-                    # Things seem to be ok so break with socket set.
-                    break
-            self._close_socket(socket)
-            socket = None
+        history = []
+        mark = _body_mark(data)
+        while True:
+            resp = self._request_once(method, url, data, json, headers, timeout)
+            location = resp.headers.get("location")
+            if not location or not 300 <= resp.status_code <= 399 or resp.status_code == 304:
+                break
+            if len(history) >= self._max_redirects:
+                resp.close()
+                raise TooManyRedirects("More than %d redirects" % self._max_redirects)
+            if resp.status_code == 303 or (
+                resp.status_code in (301, 302) and method not in ("GET", "HEAD")
+            ):
+                # the next hop fetches the result, the body isn't sent again
+                method = "GET"
+                data = json = None
+            elif not _rewind_body(data, mark):
+                break  # 307/308 need the body again and it can't be replayed
+            target = _join_url(url, location)
+            if _split_url(target)[:3] != _split_url(url)[:3] and "Authorization" in headers:
+                headers = dict(headers)
+                del headers["Authorization"]
+            self._leave_redirect(resp)
+            history.append(resp)
+            url = target
+
+        if history:
+            resp.history = history
+        self._last_response = resp
+        return resp
 
-        if not socket:
-            raise OutOfRetries("Repeated socket failures")
+    def prepare(self, method, url, headers=None):
+        """A PreparedRequest for sending 'method' to 'url' with 'headers'
+        over and over, with only the body changing"""
+        return PreparedRequest(self, method, url, headers)
+
+    def head(self, url, **kw):
+        """Send HTTP HEAD request"""
+        return self.request("HEAD", url, **kw)
+
+    def get(self, url, **kw):
+        """Send HTTP GET request"""
+        return self.request("GET", url, **kw)
+
+    def post(self, url, **kw):
+        """Send HTTP POST request"""
+        return self.request("POST", url, **kw)
+
+    def put(self, url, **kw):
+        """Send HTTP PUT request"""
+        return self.request("PUT", url, **kw)
+
+    def patch(self, url, **kw):
+        """Send HTTP PATCH request"""
+        return self.request("PATCH", url, **kw)
+
+    def delete(self, url, **kw):
+        """Send HTTP DELETE request"""
+        return self.request("DELETE", url, **kw)
 
-        resp = Response(socket, self)  # our response
-        if "location" in resp.headers and 300 <= resp.status_code <= 399:
-            # a naive handler for redirects
-            redirect = resp.headers["location"]
-
-            if redirect.startswith("http"):
-                # absolute URL
-                url = redirect
-            elif redirect[0] == "/":
-                # relative URL, absolute path
-                url = "/".join([proto, dummy, host, redirect[1:]])
+    # pylint: disable=too-many-arguments
+    def download(
+        self,
+        url,
+        path,
+        headers=None,
+        retries=5,
+        backoff_ms=500,
+        max_backoff_ms=8000,
+        buffer_size=1024,
+        progress=None,
+    ):
+        """Download 'url' into the file at 'path', picking up where an earlier
+        attempt stopped. Requests use 'Range: bytes=N-' with If-Range so a
+        changed file starts over; the ETag is kept next to the partial file
+        as 'path.etag'. Failures are retried up to 'retries' times, waiting
+        'backoff_ms' doubling up to 'max_backoff_ms' in between. Returns a
+        dict with the bytes in the file, how many of them were already there,
+        the retries, the time in ms and the throughput in bytes/s"""
+        retry = (retries, backoff_ms, max_backoff_ms)
+        fetch = _RangeFetch(self, url, path, headers, retry, etag=_read_etag(path))
+        try:
+            return _run_fetches([fetch], buffer_size, progress)
+        finally:
+            if fetch.done:
+                _remove(path + ".etag")
             else:
-                # relative URL, relative path
-                path = path.rsplit("/", 1)[0]
+                _write_etag(path, fetch.etag)
 
-                while redirect.startswith("../"):
-                    path = path.rsplit("/", 1)[0]
-                    redirect = redirect.split("../", 1)[1]
 
-                url = "/".join([proto, dummy, host, path, redirect])
+class StripedSession:
+    """Spreads requests over several Sessions, typically one per WizFi360
+    SocketPool, so more than one module carries traffic. Each request goes
+    to the next session whose last response has been closed, round robin"""
 
-            self._last_response = resp
-            resp = self.request(method, url, data, json, headers, stream, timeout)
+    def __init__(self, sessions):
+        if not sessions:
+            raise ValueError("Need at least one session")
+        self._sessions = list(sessions)
+        self._next = 0
 
-        self._last_response = resp
-        return resp
+    @property
+    def sessions(self):
+        """The sessions we spread requests over"""
+        return self._sessions
+
+    def _pick(self):
+        count = len(self._sessions)
+        for i in range(count):
+            session = self._sessions[(self._next + i) % count]
+            last = session._last_response  # pylint: disable=protected-access
+            if last is None or last.socket is None:
+                self._next = (self._next + i + 1) % count
+                return session
+        session = self._sessions[self._next]
+        self._next = (self._next + 1) % count
+        return session
+
+    def request(self, method, url, **kw):
+        """Send the request on the next free session"""
+        return self._pick().request(method, url, **kw)
+
+    # pylint: disable=too-many-arguments, too-many-locals
+    def download(
+        self,
+        url,
+        path,
+        headers=None,
+        retries=5,
+        backoff_ms=500,
+        max_backoff_ms=8000,
+        buffer_size=1024,
+        progress=None,
+        min_part=16384,
+    ):
+        """Session.download(), but with the file split in one byte range per
+        session, fetched side by side and joined at the end. Falls back to a
+        single session if the server doesn't do ranges or the file is
+        smaller than 'min_part' per session. Each part 'path.N' keeps its
+        range and ETag in 'path.N.etag', and is started over if those
+        don't match what the server has now"""
+        session = self._sessions[0]
+        probe_headers = dict(headers or {})
+        probe_headers["Range"] = "bytes=0-0"
+        probe_headers["Accept-Encoding"] = "identity"
+        resp = session.get(url, headers=probe_headers, stream=True)
+        total = etag = None
+        if resp.status_code == 206:
+            total = _parse_content_range(resp.headers.get("content-range", ""))[2]
+            etag = resp.headers.get("etag")
+        resp.close()
+        count = len(self._sessions)
+        if not total or not etag or count < 2 or total < min_part * count:
+            return session.download(
+                url, path, headers, retries, backoff_ms, max_backoff_ms, buffer_size, progress
+            )
+        retry = (retries, backoff_ms, max_backoff_ms)
+        part_size = (total + count - 1) // count
+        fetches = []
+        for i, part_session in enumerate(self._sessions):
+            start = i * part_size
+            end = min(start + part_size, total) - 1
+            part = "%s.%d" % (path, i)
+            # a part is only resumed if it's this range of this version
+            key = "%d-%d/%d %s" % (start, end, total, etag)
+            if _read_etag(part) != key:
+                _remove(part)
+                _write_etag(part, key)
+            fetches.append(
+                _RangeFetch(part_session, url, part, headers, retry, start, end, etag)
+            )
+        stats = _run_fetches(fetches, buffer_size, progress)
+        buf = bytearray(buffer_size)
+        with open(path, "wb") as out:
+            for i in range(count):
+                part = "%s.%d" % (path, i)
+                with open(part, "rb") as file:
+                    while True:
+                        size = file.readinto(buf)
+                        if not size:
+                            break
+                        out.write(memoryview(buf)[:size])
+                _remove(part)
+                _remove(part + ".etag")
+        return stats
 
     def head(self, url, **kw):
         """Send HTTP HEAD request"""
@@ -635,8 +2112,15 @@ class _FakeSSLSocket:
         self.settimeout = socket.settimeout
         self.send = socket.send
         self.recv = socket.recv
+        if hasattr(socket, "recv_into"):
+            self.recv_into = socket.recv_into
         self.close = socket.close
 
+    @property
+    def connected(self):
+        """Whether the wrapped socket's link is still up, if it can tell"""
+        return getattr(self._socket, "connected", True)
+
     def connect(self, address):
         """connect wrapper to add non-standard mode parameter"""
         try:
@@ -0,0 +1,357 @@
+# SPDX-FileCopyrightText: 2020 Scott Shawcroft for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_requests_json`
+================================================================================
+
+Pull a few values out of a JSON document while it streams in, without
+building the whole object tree. Used by `adafruit_requests.Response.json_select`
+
+Paths are dotted keys with list indexes: "current.temp", "items[0].name",
+and "items[*].id" for every element of a list.
+
+* Author(s): WIZnet
+
+Implementation Notes
+--------------------
+
+**Hardware:**
+
+* WIZnet `WizFi360-EVB-Pico
+  <https://docs.wiznet.io/Product/Open-Source-Hardware/wizfi360-evb-pico>`
+
+**Software and Dependencies:**
+
+* Reference software:
+  https://github.com/Wiznet/WizFi360-EVB-Pico-MicroPython
+
+"""
+
+_ANY = None  # the [*] step
+
+_ESCAPES = {
+    ord("b"): "\b",
+    ord("f"): "\f",
+    ord("n"): "\n",
+    ord("r"): "\r",
+    ord("t"): "\t",
+}
+
+
+def parse_path(path):
+    """'items[*].id' -> ['items', None, 'id']"""
+    steps = []
+    for part in path.split("."):
+        while part:
+            bracket = part.find("[")
+            if bracket < 0:
+                steps.append(part)
+                break
+            if bracket:
+                steps.append(part[:bracket])
+            close = part.find("]", bracket)
+            if close < 0:
+                raise ValueError("Bad path: " + path)
+            index = part[bracket + 1 : close]
+            steps.append(_ANY if index == "*" else int(index))
+            part = part[close + 1 :]
+    return steps
+
+
+class _Reader:
+    """Byte at a time access to a stream read in 'buffer_size' pieces"""
+
+    def __init__(self, readinto, buffer_size):
+        self._readinto = readinto
+        self._buf = bytearray(buffer_size)
+        self._pos = 0
+        self._end = 0
+
+    def peek(self):
+        """The next byte without consuming it, -1 at the end"""
+        if self._pos == self._end:
+            self._end = self._readinto(self._buf)
+            self._pos = 0
+            if not self._end:
+                return -1
+        return self._buf[self._pos]
+
+    def next(self):
+        """Consume and return the next byte, -1 at the end"""
+        byte = self.peek()
+        self._pos += 1
+        return byte
+
+    def skip_space(self):
+        """Consume whitespace, returns the byte after it"""
+        while True:
+            byte = self.peek()
+            if byte not in (0x20, 0x0A, 0x0D, 0x09):
+                return byte
+            self._pos += 1
+
+    def skip_string(self):
+        """Consume the rest of a string whose opening quote is gone"""
+        buf = self._buf
+        while True:
+            if self._pos == self._end and self.peek() < 0:
+                raise ValueError("Unterminated string")
+            # jump to the next quote or backslash in the buffered data
+            pos = self._pos
+            end = self._end
+            while pos < end and buf[pos] != 0x22 and buf[pos] != 0x5C:
+                pos += 1
+            self._pos = pos
+            if pos == end:
+                continue
+            self._pos += 1
+            if buf[pos] == 0x22:
+                return
+            self.next()  # the escaped byte
+
+
+class _Selector:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, paths, readinto, buffer_size):
+        self._reader = _Reader(readinto, buffer_size)
+        self._paths = [(path, parse_path(path)) for path in paths]
+        self.results = {}
+        for path, steps in self._paths:
+            self.results[path] = [] if _ANY in steps else None
+        self._pending = sum(1 for _, steps in self._paths if _ANY not in steps)
+        self._wildcards = len(self._paths) - self._pending
+
+    def run(self):
+        """Walk the document, keeping what the paths ask for"""
+        self._value([])
+        return self.results
+
+    def _done(self):
+        return not self._pending and not self._wildcards
+
+    def _match(self, location):
+        """Paths that end at 'location' and whether any goes deeper"""
+        ends = []
+        deeper = False
+        depth = len(location)
+        for path, steps in self._paths:
+            if len(steps) < depth:
+                continue
+            for i in range(depth):
+                step = steps[i]
+                if step != location[i] and not (
+                    step is _ANY and isinstance(location[i], int)
+                ):
+                    break
+            else:
+                if len(steps) == depth:
+                    ends.append((path, steps))
+                else:
+                    deeper = True
+        return ends, deeper
+
+    def _value(self, location):
+        ends, deeper = self._match(location)
+        if ends:
+            value = self._build()
+            for path, steps in ends:
+                self._keep(path, steps, value)
+            if deeper:
+                self._select_from(value, location)
+            return
+        byte = self._reader.skip_space()
+        if not deeper:
+            self._skip()
+        elif byte == 0x7B:  # {
+            self._object(location)
+        elif byte == 0x5B:  # [
+            self._array(location)
+        else:
+            self._skip()
+
+    def _keep(self, path, steps, value):
+        if _ANY in steps:
+            self.results[path].append(value)
+        elif self.results[path] is None:
+            self.results[path] = value
+            self._pending -= 1
+
+    def _select_from(self, value, location):
+        """Resolve deeper paths against a value we built anyway"""
+        depth = len(location)
+        for path, steps in self._paths:
+            if len(steps) > depth and all(
+                steps[i] == location[i] or steps[i] is _ANY for i in range(depth)
+            ):
+                for found in _walk(value, steps[depth:]):
+                    self._keep(path, steps, found)
+
+    def _object(self, location):
+        reader = self._reader
+        reader.next()  # {
+        if reader.skip_space() == 0x7D:
+            reader.next()
+            return
+        while True:
+            if reader.skip_space() != 0x22:
+                raise ValueError("Expected a key")
+            reader.next()
+            location.append(self._string())
+            if reader.skip_space() != 0x3A:
+                raise ValueError("Expected ':'")
+            reader.next()
+            self._value(location)
+            location.pop()
+            byte = reader.skip_space()
+            reader.next()
+            if byte == 0x7D or self._done():
+                return
+            if byte != 0x2C:
+                raise ValueError("Expected ',' or '}'")
+
+    def _array(self, location):
+        reader = self._reader
+        reader.next()  # [
+        if reader.skip_space() == 0x5D:
+            reader.next()
+            return
+        index = 0
+        while True:
+            location.append(index)
+            self._value(location)
+            location.pop()
+            byte = reader.skip_space()
+            reader.next()
+            if byte == 0x5D or self._done():
+                return
+            if byte != 0x2C:
+                raise ValueError("Expected ',' or ']'")
+            index += 1
+
+    def _skip(self):
+        """Consume one value without building it"""
+        reader = self._reader
+        depth = 0
+        while True:
+            byte = reader.skip_space()
+            if byte < 0:
+                raise ValueError("Unexpected end of JSON")
+            if byte == 0x22:
+                reader.next()
+                reader.skip_string()
+            elif byte in (0x7B, 0x5B):
+                reader.next()
+                depth += 1
+            elif byte in (0x7D, 0x5D):
+                reader.next()
+                depth -= 1
+            elif byte in (0x2C, 0x3A):
+                reader.next()
+            else:
+                # number, true, false, null
+                while reader.peek() not in (-1, 0x2C, 0x7D, 0x5D, 0x20, 0x0A, 0x0D, 0x09):
+                    reader.next()
+            if not depth:
+                return
+
+    def _string(self):
+        """Read the rest of a string whose opening quote is gone"""
+        reader = self._reader
+        raw = bytearray()
+        while True:
+            byte = reader.next()
+            if byte < 0:
+                raise ValueError("Unterminated string")
+            if byte == 0x22:
+                return str(raw, "utf-8")
+            if byte != 0x5C:
+                raw.append(byte)
+                continue
+            byte = reader.next()
+            if byte == 0x75:  # \uXXXX
+                code = self._hex4()
+                if 0xD800 <= code < 0xDC00 and reader.next() == 0x5C:
+                    reader.next()  # u of the low surrogate
+                    code = 0x10000 + ((code - 0xD800) << 10) + self._hex4() - 0xDC00
+                raw.extend(chr(code).encode("utf-8"))
+            else:
+                char = _ESCAPES.get(byte)
+                raw.extend(char.encode() if char else bytes((byte,)))
+
+    def _hex4(self):
+        reader = self._reader
+        return int(bytes([reader.next() for _ in range(4)]), 16)
+
+    def _build(self):
+        """Read one value into a Python object"""
+        reader = self._reader
+        byte = reader.skip_space()
+        if byte == 0x22:
+            reader.next()
+            return self._string()
+        if byte == 0x7B:
+            reader.next()
+            obj = {}
+            if reader.skip_space() == 0x7D:
+                reader.next()
+                return obj
+            while True:
+                reader.skip_space()
+                reader.next()  # "
+                key = self._string()
+                reader.skip_space()
+                reader.next()  # :
+                obj[key] = self._build()
+                if reader.skip_space() == 0x7D:
+                    reader.next()
+                    return obj
+                reader.next()  # ,
+        if byte == 0x5B:
+            reader.next()
+            items = []
+            if reader.skip_space() == 0x5D:
+                reader.next()
+                return items
+            while True:
+                items.append(self._build())
+                if reader.skip_space() == 0x5D:
+                    reader.next()
+                    return items
+                reader.next()  # ,
+        raw = bytearray()
+        while reader.peek() not in (-1, 0x2C, 0x7D, 0x5D, 0x20, 0x0A, 0x0D, 0x09):
+            raw.append(reader.next())
+        if raw == b"true":
+            return True
+        if raw == b"false":
+            return False
+        if raw == b"null":
+            return None
+        if b"." in raw or b"e" in raw or b"E" in raw:
+            return float(raw)
+        return int(raw)
+
+
+def _walk(value, steps):
+    """Values at 'steps' below an already built 'value'"""
+    if not steps:
+        yield value
+        return
+    step = steps[0]
+    if step is _ANY:
+        if isinstance(value, list):
+            for item in value:
+                yield from _walk(item, steps[1:])
+    elif isinstance(step, int):
+        if isinstance(value, list) and step < len(value):
+            yield from _walk(value[step], steps[1:])
+    elif isinstance(value, dict) and step in value:
+        yield from _walk(value[step], steps[1:])
+
+
+def select(readinto, paths, buffer_size=256):
+    """Read a JSON document through 'readinto(buffer)' and return a dict with
+    the value for each of 'paths': None if missing, a list for [*] paths"""
+    return _Selector(paths, readinto, buffer_size).run()
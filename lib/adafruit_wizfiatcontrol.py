@@ -34,7 +34,7 @@ import gc
 import time
 from machine import UART, Pin
 try:
-    from typing import Optional, Dict, Union, List
+    from typing import Optional, Dict, Union, List, Tuple
 
 except ImportError:
     pass
@@ -49,7 +49,17 @@ WIZFI360_ALREADY_CONNECTED= "ALREADY CONNECTED\r\n"
 WIZFI360_WIFI_AP_NOT_PRESENT="WIFI AP NOT FOUND\r\n"
 WIZFI360_WIFI_AP_WRONG_PWD="WIFI AP WRONG PASSWORD\r\n"
 WIZFI360_BUSY_STATUS="busy p...\r\n"
+WIZFI360_LEASE_FILE="wizfi360_lease.txt"
+WIZFI360_MQTT_SEPARATOR=b" -> "
+WIZFI360_MAX_SEND=2048  # most AT+CIPSEND takes at once
 SUB_CNT_MAX= 5
+
+# Oldest AT firmware ("AT version:" in AT+GMR) that has each faster command path
+WIZFI360_FEATURE_VERSIONS = {
+    "mqtt_qos": (1, 1, 1, 8),  # AT+MQTTQOS
+    "mqtt_pubsend": (1, 1, 1, 8),  # AT+MQTTPUBSEND length-prefixed publish
+}
+
 class OKError(Exception):
     """The exception thrown when we didn't get acknowledgement to an AT command"""
     
@@ -103,12 +113,27 @@ class WizFi_ATcontrol:
         self._debug = debug
         self._versionstrings = []
         self._version = None
-        self._ipdpacket = bytearray(1500)
+        self._version_tuple = None
+        self.features = {}
         self._ifconfig = []
         self._initialized = False
         self._conntype = None
+        self._dhcp_enabled = True
+        self._lease = None
+        self._dhcp_ms = None
+        self.connect_metrics = {}
         
+        self._urc_handlers = []
+        self._urc_buf = b""
+        self._ipd_remaining = 0
+        self._rx_pending = bytearray()
+        self._link_open = False
+        # bumped by every socket_connect() so sockets can tell whether the
+        # module's single link is still theirs
+        self.link_serial = 0
+
         self.is_mqtt_conn=False
+        self._mqtt_config = {}
         self._mqtt_packet_msg= b""
         self._mqtt_topic_msg= b""
         
@@ -126,13 +151,17 @@ class WizFi_ATcontrol:
                 #self.echo(False)
                 # set flow control if required
                 #self.baudrate = self._run_baudrate
-                # get and cache versionstring
-                #self.get_version()
+                # get and cache versionstring and what this firmware can do
+                self.probe_features()
                 if self.cipmux != 0:
                     self.cipmux = 0
-                try:
-                    self.at_response("AT+CIPSSLSIZE=4096", retries=1, timeout=3)
-                except OKError:
+                if self.features.get("ssl_size", True):
+                    try:
+                        self.at_response("AT+CIPSSLSIZE=4096", retries=1, timeout=3)
+                        self.features["ssl_size"] = True
+                    except OKError:
+                        self.features["ssl_size"] = False
+                if not self.features["ssl_size"]:
                     self.at_response("AT+CIPSSLCCONF?")
                 self._initialized = True
                 return
@@ -145,24 +174,39 @@ class WizFi_ATcontrol:
         """Repeatedly try to connect to an access point with the details in
         the passed in 'secrets' dictionary. Be sure 'ssid' and 'password' are
         defined in the secrets dict! If 'timezone' is set, we'll also configure
-        SNTP"""
+        SNTP. If 'ip' (with 'gateway' and 'netmask') is set we use that static
+        address, and if 'reuse_lease' is True we reuse the last DHCP lease, so
+        we return as soon as the module is associated"""
         # Connect to WiFi if not already
         AP = self.remote_AP  # pylint: disable=invalid-name
         if AP[0] != secrets["ssid"]:
-            self.join_AP(
-                secrets["ssid"],
-                secrets["password"],
-                timeout=timeout,
-                retries=retries
-            )
+            static = self.configure_ip(secrets)
+            try:
+                self.join_AP(
+                    secrets["ssid"],
+                    secrets["password"],
+                    timeout=timeout,
+                    retries=retries,
+                    wait_ip=not static,
+                )
+            except RuntimeError:
+                if static and "ip" not in secrets:
+                    # the cached lease may be stale, go back to DHCP next time
+                    self.forget_lease()
+                raise
             print("Connected to", secrets["ssid"])
+            if not static and secrets.get("reuse_lease"):
+                self.save_lease(secrets["ssid"])
             if "timezone" in secrets:
                 tzone = secrets["timezone"]
                 ntp = None
                 if "ntp_server" in secrets:
                     ntp = secrets["ntp_server"]
                 self.sntp_config(True, tzone, ntp)
-            print("My IP Address:", self.local_ip)
+            if static:
+                print("My IP Address:", self._lease[0])
+            else:
+                print("My IP Address:", self.local_ip)
         else:
             print("Already connected to", AP[0])
         return  # yay!
@@ -189,6 +233,7 @@ class WizFi_ATcontrol:
         can be an IP address or DNS (we'll do the lookup for you. Remote port
         is integer port on other side. We can't set the local port"""
         # lets just do one connection at a time for now
+        self._reset_rx()
         if conntype == self.TYPE_UDP:
             # always disconnect for TYPE_UDP
             self.socket_disconnect()
@@ -202,6 +247,8 @@ class WizFi_ATcontrol:
                 time.sleep(1)
         if not conntype in (self.TYPE_TCP, self.TYPE_UDP, self.TYPE_SSL):
             raise RuntimeError("Connection type must be TCP, UDL or SSL")
+        # anything the status checks picked up belongs to the old link
+        self._reset_rx()
         cmd = (
             'AT+CIPSTART="'
             + conntype
@@ -220,128 +267,91 @@ class WizFi_ATcontrol:
                 or conntype == self.TYPE_UDP
             ):
                 self._conntype = conntype
+                self._link_open = True
+                self.link_serial += 1
                 return True
             if reply == b"ALREADY CONNECTED":
+                self._link_open = True
+                self.link_serial += 1
                 return True
         return False
         
         
     def socket_send(self, buffer: bytes, timeout: int = 10) -> bool:
-        """Send data over the already-opened socket, buffer must be bytes"""
-        
-        cmd = "AT+CIPSEND=%d" % len(buffer)
-        
-        prompt = b""
-        prompt= self.at_response(cmd, timeout=10, retries=1)
-        
-        if b">" not in prompt:
-            stamp = time.ticks_ms()
-            while (time.ticks_ms() - stamp) < timeout:
-                if self._uart.any():
-                    prompt += self._uart.read(1)
-                    self.hw_flow(False)
-                if  b">" in prompt:
-                    break
-                else:
-                    self.hw_flow(True)
-                    
-        if not prompt or ( b">" not in prompt):
-            raise RuntimeError("Didn't get data prompt for sending")
-        self._uart.write(buffer)
-        if self._conntype == self.TYPE_UDP:
-            return True
-        stamp = time.ticks_ms()/1000
-        
-        response = b""
-        while (time.ticks_ms()/1000 - stamp) < timeout:
-            stamp = time.ticks_ms()/1000
-            if self._uart.any(): 
-                response += self._uart.read(1)
-                if response[-9:] == b"SEND OK\r\n":
-                    break
-                if response[-7:] == b"ERROR\r\n":
-                    break
-        if self._debug:
-            print("<---", response)
-        # Get newlines off front and back, then split into lines
+        """Send data over the already-opened socket, buffer must be bytes.
+        More than WIZFI360_MAX_SEND bytes go out as several CIPSENDs"""
+        self._flush()
+        view = memoryview(buffer)
+        for start in range(0, len(view), WIZFI360_MAX_SEND):
+            chunk = view[start : start + WIZFI360_MAX_SEND]
+            self._at_write("AT+CIPSEND=%d" % len(chunk))
+            prompt = self._read_until((b">", b"ERROR\r\n"), timeout, cut=True)
+            if b">" not in prompt:
+                raise RuntimeError("Didn't get data prompt for sending")
+            self._uart.write(chunk)
+            if self._conntype == self.TYPE_UDP:
+                continue
+            response = self._read_until(
+                (b"SEND OK\r\n", b"SEND FAIL\r\n", b"ERROR\r\n"), timeout, cut=True
+            )
+            if b"SEND OK" not in response:
+                return False
         return True
 
-    def socket_receive(self, timeout: int = 15) -> bytearray:
-        # pylint: disable=too-many-nested-blocks, too-many-branches
-        """Check for incoming data over the open socket returns bytes"""
-        incoming_bytes = None
-        bundle = []
-        toread = 0
-        gc.collect()
-        ipdpacket = []
-        
-        i = 0  # index into our internal packet
-        stamp = time.ticks_ms()/1000
-        ipd_start = b"+IPD,"
-        while (time.ticks_ms()/1000 - stamp) < timeout:
-            if self._uart.any()>0: #self._uart.in_waiting:
-                stamp = time.ticks_ms()/1000  # reset timestamp when there's data!
-                if not incoming_bytes:
-                    self.hw_flow(False)  # stop the flow
-                    # read one byte at a time
-                    self._ipdpacket[i] = self._uart.read(1)[0]
-                    if chr(self._ipdpacket[0]) != "+":
-                        i = 0  # keep goin' till we start with +
-                        continue
-                    i += 1
-                    # look for the IPD message
-                    if (ipd_start in self._ipdpacket) and chr(
-                        self._ipdpacket[i - 1]
-                    ) == ":":
-                        try:
-                            ipd = str(self._ipdpacket[5 : i - 1], "utf-8")
-                            incoming_bytes = int(ipd)
-                            if self._debug:
-                                print("Receiving:", incoming_bytes)
-                        except ValueError as err:
-                            raise RuntimeError(
-                                "Parsing error during receive", ipd
-                            ) from err
-                        i = 0  # reset the input buffer now that we know the size
-                    elif i > 20:
-                        i = 0  # Hmm we somehow didnt get a proper +IPD packet? start over
-
-                else:
-                    self.hw_flow(False)  # stop the flow
-                    # read as much as we can!
-                    #toread = min(incoming_bytes - i, self._uart.in_waiting)
-                    toread = min(incoming_bytes - i, self._uart.any())
-                    # print("i ", i, "to read:", toread)
-                    self._ipdpacket[i : i + toread] = self._uart.read(toread)
-                    i += toread
-                    if i == incoming_bytes:
-                        # print(self._ipdpacket[0:i])
-                        gc.collect()
-                        bundle.append(self._ipdpacket[0:i])
-                        gc.collect()
-                        i = incoming_bytes = 0
-                        break  # We've received all the data. Don't wait until timeout.
-            else:  # no data waiting
-                self.hw_flow(True)  # start the floooow
-        totalsize = sum([len(x) for x in bundle])
-        ret = bytearray(totalsize)
-        i = 0
-        for x in bundle:
-            for char in x:
-                ret[i] = char
-                i += 1
-        for x in bundle:
-            del x
-        gc.collect()
+    def socket_receive(self, timeout: Optional[float] = 15) -> bytearray:
+        """Wait for data over the open socket and return it. Gives up after
+        'timeout' seconds without data (None waits until data arrives or the
+        link closes, 0 only takes what is already here) and returns an empty
+        bytearray then"""
+        self.hw_flow(True)
+        if timeout is not None:
+            timeout_ms = int(timeout * 1000)
+        stamp = time.ticks_ms()
+        while True:
+            received = len(self._rx_pending)
+            self.poll_urc()
+            if self._rx_pending and not self._ipd_remaining:
+                break  # got whole +IPD packets
+            if len(self._rx_pending) > received:
+                stamp = time.ticks_ms()  # reset timestamp when there's data!
+            elif not self._link_open and not self._ipd_remaining:
+                break
+            elif timeout is not None and (
+                time.ticks_diff(time.ticks_ms(), stamp) >= timeout_ms
+            ):
+                break
+        ret = self._rx_pending
+        self._rx_pending = bytearray()
+        if self._debug and ret:
+            print("Receiving:", len(ret))
         return ret
 
+    def socket_available(self) -> int:
+        """Number of received bytes waiting for socket_receive(), without blocking"""
+        self.poll_urc()
+        return len(self._rx_pending)
+
+    @property
+    def socket_open(self) -> bool:
+        """False once the module reported the open socket CLOSED"""
+        return self._link_open
+
     def socket_disconnect(self) -> None:
         """Close any open socket, if there is one"""
         self._conntype = None
+        self._link_open = False
         try:
             self.at_response("AT+CIPCLOSE", retries=1)
         except OKError:
             pass  # this is ok, means we didn't have an open socket
+        # data of the closed link must not turn up on the next one
+        self._reset_rx()
+
+    def _reset_rx(self) -> None:
+        """Forget received data, including a +IPD payload still coming in"""
+        self._rx_pending = bytearray()
+        self._ipd_remaining = 0
+        self._urc_buf = b""
 
     # *************************** SNTP SETUP ****************************
 
@@ -477,10 +487,17 @@ class WizFi_ATcontrol:
         return [None] * 4
 
     def join_AP(  # pylint: disable=invalid-name
-        self, ssid: str, password: str, timeout: int = 100, retries: int = 3
+        self,
+        ssid: str,
+        password: str,
+        timeout: int = 100,
+        retries: int = 3,
+        wait_ip: bool = True,
     ) -> None:
         """Try to join an access point by name and password, will return
-        immediately if we're already connected and won't try to reconnect"""
+        immediately if we're already connected and won't try to reconnect.
+        If 'wait_ip' is False (static IP) we return as soon as we're associated
+        instead of waiting for 'WIFI GOT IP'"""
         # First make sure we're in 'station' mode so we can connect to AP's
         if self.mode != self.MODE_STATION:
             self.mode = self.MODE_STATION
@@ -488,21 +505,119 @@ class WizFi_ATcontrol:
         router = self.remote_AP
         if router and router[0] == ssid:
             return  # we're already connected!
-        reply = self.at_response(
-            'AT+CWJAP="' + ssid + '","' + password + '"',
-            timeout=timeout,
-            retries=retries,
-        )
-
-        if b"WIFI CONNECTED" not in reply:
+        cmd = 'AT+CWJAP="' + ssid + '","' + password + '"'
+        failures = (b"FAIL\r\n", b"ERROR\r\n")
+        reply = b""
+        stamp = time.ticks_ms()
+        for _ in range(retries):
+            self._flush()
+            self._at_write(cmd)
+            reply = self._read_until((b"WIFI CONNECTED\r\n",) + failures, timeout)
+            if b"WIFI CONNECTED\r\n" in reply:
+                break
+            time.sleep(1)
+        if b"WIFI CONNECTED\r\n" not in reply:
             print("no CONNECTED")
             raise RuntimeError("Couldn't connect to WiFi")
-        if b"WIFI GOT IP" not in reply:
-            print("no IP")
-            raise RuntimeError("Didn't get IP address")
-        reply = self.at_response("AT+CIPSTA_CUR?",timeout=timeout,retries=retries,)
-        print(reply)
-        return
+        associated = time.ticks_ms()
+        metrics = {
+            "associate_ms": time.ticks_diff(associated, stamp),
+            "dhcp_ms": 0,
+            "static_ip": not wait_ip,
+            "saved_ms": 0,
+        }
+        if wait_ip:
+            if b"WIFI GOT IP\r\n" not in reply:
+                reply += self._read_until((b"WIFI GOT IP\r\n",) + failures, timeout)
+            if b"WIFI GOT IP\r\n" not in reply:
+                print("no IP")
+                raise RuntimeError("Didn't get IP address")
+            self._dhcp_ms = time.ticks_diff(time.ticks_ms(), associated)
+            metrics["dhcp_ms"] = self._dhcp_ms
+        elif self._dhcp_ms is not None:
+            # what the last DHCP handshake cost us
+            metrics["saved_ms"] = self._dhcp_ms
+        # AT+CWJAP is still running until its OK, which must not be taken
+        # for the reply to whatever command comes next
+        if b"OK\r\n" not in reply:
+            reply += self._read_until((b"OK\r\n",) + failures, timeout)
+        if b"OK\r\n" not in reply:
+            raise RuntimeError("Couldn't connect to WiFi")
+        metrics["total_ms"] = time.ticks_diff(time.ticks_ms(), stamp)
+        self.connect_metrics = metrics
+        if self._debug:
+            print("Join metrics:", metrics)
+
+    def configure_ip(self, secrets: Dict[str, Union[str, int]]) -> bool:
+        """Set up the station address before joining. Uses the static 'ip',
+        'gateway' and 'netmask' from secrets, or the last DHCP lease if
+        'reuse_lease' is set, otherwise (re-)enables DHCP. Returns True if
+        a static address is in use and DHCP can be skipped"""
+        lease = None
+        if "ip" in secrets:
+            lease = (secrets["ip"], secrets["gateway"], secrets["netmask"])
+        elif secrets.get("reuse_lease"):
+            lease = self.load_lease(secrets["ssid"])
+        if not lease:
+            if not self._dhcp_enabled:
+                self.at_response("AT+CWDHCP_CUR=1,1", timeout=3)
+                self._dhcp_enabled = True
+            return False
+        if self._dhcp_enabled:
+            self.at_response("AT+CWDHCP_CUR=1,0", timeout=3)
+            self._dhcp_enabled = False
+        self.at_response('AT+CIPSTA_CUR="%s","%s","%s"' % lease, timeout=3)
+        self._lease = lease
+        return True
+
+    def station_ip(self) -> Union[tuple, None]:
+        """The (ip, gateway, netmask) the station is currently using, from AT+CIPSTA_CUR?"""
+        reply = self.at_response("AT+CIPSTA_CUR?", timeout=3)
+        info = {}
+        for line in reply.split(b"\r\n"):
+            if line.startswith(b"+CIPSTA_CUR:"):
+                key, _, value = line[12:].partition(b":")
+                info[key] = str(value, "utf-8").strip('"')
+        try:
+            return (info[b"ip"], info[b"gateway"], info[b"netmask"])
+        except KeyError:
+            return None
+
+    def save_lease(self, ssid: str) -> None:
+        """Remember the current DHCP lease (and what DHCP cost us) in RAM and
+        on flash so the next connect to 'ssid' can skip DHCP"""
+        lease = self.station_ip()
+        if not lease or lease[0] == "0.0.0.0":
+            return
+        self._lease = lease
+        try:
+            with open(WIZFI360_LEASE_FILE, "w") as file:
+                file.write("\n".join((ssid,) + lease + (str(self._dhcp_ms or 0),)))
+        except OSError:
+            pass  # read-only filesystem, the RAM copy still works until reset
+
+    def load_lease(self, ssid: str) -> Union[tuple, None]:
+        """Return the cached (ip, gateway, netmask) lease for 'ssid', if any"""
+        try:
+            with open(WIZFI360_LEASE_FILE) as file:
+                fields = file.read().split("\n")
+        except OSError:
+            return None
+        if len(fields) != 5 or fields[0] != ssid:
+            return None
+        if self._dhcp_ms is None:
+            self._dhcp_ms = int(fields[4]) or None
+        return tuple(fields[1:4])
+
+    def forget_lease(self) -> None:
+        """Drop the cached DHCP lease"""
+        self._lease = None
+        try:
+            import os  # pylint: disable=import-outside-toplevel
+
+            os.remove(WIZFI360_LEASE_FILE)
+        except OSError:
+            pass
 
     def scan_APs(  # pylint: disable=invalid-name
         self, retries: int = 3
@@ -541,12 +656,217 @@ class WizFi_ATcontrol:
         version number"""
         reply = self.at_response("AT+GMR", timeout=3) 
         self._version = None
+        self._version_tuple = None
         for line in reply.split(b"\r\n"):
-            if line:
-                if b"version" in line:
-                    self._version = str(line, "utf-8")
+            if line.startswith(b"AT version:"):
+                self._version = str(line, "utf-8")
+                self._version_tuple = self._parse_version(line[11:])
+            elif self._version is None and b"version" in line:
+                self._version = str(line, "utf-8")
         return self._version
 
+    @staticmethod
+    def _parse_version(text: bytes) -> Union[tuple, None]:
+        """Turn b'1.1.1.8(May  4 2021)' into (1, 1, 1, 8)"""
+        text = text.split(b"(", 1)[0].strip()
+        try:
+            return tuple(int(part) for part in text.split(b"."))
+        except ValueError:
+            return None
+
+    def probe_features(self, refresh: bool = False) -> Dict[str, bool]:
+        """Ask the firmware for its version once (AT+GMR) and work out which of
+        the faster command paths in WIZFI360_FEATURE_VERSIONS it supports. The
+        result is cached in 'features', which can also be edited by hand"""
+        if self._version_tuple is None or refresh:
+            try:
+                self.get_version()
+            except OKError:
+                pass  # unknown firmware, stick to the common commands
+        for name, min_version in WIZFI360_FEATURE_VERSIONS.items():
+            self.features[name] = bool(
+                self._version_tuple and self._version_tuple >= min_version
+            )
+        return self.features
+
+    def has_feature(self, name: str) -> bool:
+        """True if the firmware supports the named command path"""
+        if not self.features:
+            self.probe_features()
+        return self.features.get(name, False)
+
+    def _flush(self) -> None:
+        """Clear the UART before a command, handing any unsolicited lines to
+        the URC handlers and keeping +IPD data instead of throwing them away"""
+        self.poll_urc()
+        # don't let the rest of a +IPD payload land in the command reply
+        stamp = time.ticks_ms()
+        while self._ipd_remaining and time.ticks_diff(time.ticks_ms(), stamp) < 1000:
+            self.poll_urc()
+
+    # ************************** URC HANDLING ****************************
+
+    def add_urc_handler(self, handler) -> None:
+        """Register 'handler(line)', called with every unsolicited line the
+        module sends (without CRLF). Return True from it to stop later
+        handlers from seeing the line"""
+        if handler not in self._urc_handlers:
+            self._urc_handlers.append(handler)
+
+    def remove_urc_handler(self, handler) -> None:
+        """Unregister a handler added with add_urc_handler()"""
+        if handler in self._urc_handlers:
+            self._urc_handlers.remove(handler)
+
+    def _dispatch_urc(self, line: bytes) -> None:
+        # 'CLOSED' or '<id>,CLOSED' in multi-link mode
+        if line == b"CLOSED" or line.endswith(b",CLOSED"):
+            self._link_open = False
+        for handler in self._urc_handlers:
+            if handler(line):
+                break
+
+    def _scan_urc(self, response: bytes) -> None:
+        """Let the URC handlers see lines that arrived mixed into a command reply"""
+        if response:
+            for line in response.split(b"\r\n"):
+                if line:
+                    self._dispatch_urc(line)
+
+    def poll_urc(self) -> int:
+        """Read whatever the module has sent without blocking. Complete lines
+        go to the URC handlers, +IPD payloads are kept for socket_receive().
+        Returns the number of lines handled"""
+        count = 0
+        if self._uart.any():
+            self._urc_buf += self._uart.read(self._uart.any())
+        buf = self._urc_buf
+        while buf:
+            if self._ipd_remaining:
+                take = min(self._ipd_remaining, len(buf))
+                self._rx_pending += buf[:take]
+                self._ipd_remaining -= take
+                buf = buf[take:]
+            elif buf.startswith(b"+IPD,"):
+                colon = buf.find(b":")
+                if colon < 0:
+                    if len(buf) > 20:
+                        buf = buf[5:]  # not a real +IPD header, skip it
+                    break
+                try:
+                    # '+IPD,<len>:' or '+IPD,<id>,<len>:' in multi-link mode
+                    self._ipd_remaining = int(buf[5:colon].split(b",")[-1])
+                except ValueError:
+                    self._ipd_remaining = 0
+                buf = buf[colon + 1 :]
+            else:
+                eol = buf.find(b"\r\n")
+                ipd = buf.find(b"+IPD,")
+                if ipd > 0 and (eol < 0 or ipd < eol):
+                    buf = buf[ipd:]  # drop leftovers like the '> ' prompt
+                    continue
+                if eol < 0:
+                    break
+                line = buf[:eol]
+                buf = buf[eol + 2 :]
+                if line:
+                    self._dispatch_urc(line)
+                    count += 1
+        self._urc_buf = buf
+        return count
+
+    def _at_write(self, at_cmd: str) -> None:
+        """Write an AT command without waiting for the reply"""
+        if self._debug:
+            print("--->", at_cmd)
+        self._uart.write(bytes(at_cmd, "utf-8"))
+        self._uart.write(b"\x0d\x0a")
+
+    def _read_until(self, needles: tuple, timeout: int = 10, cut: bool = False) -> bytes:
+        """Read the UART until one of 'needles' shows up or 'timeout' seconds
+        have passed, and return everything we read. +IPD frames that arrive
+        meanwhile go to socket_receive() and aren't searched. With 'cut',
+        whatever came after the needle (more data, URCs) is left for
+        poll_urc() instead"""
+        response = b""
+        raw = b""
+        timeout_ms = int(timeout * 1000)
+        stamp = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), stamp) < timeout_ms:
+            if not self._uart.any():
+                continue
+            raw += self._uart.read(self._uart.any())
+            text, raw = self._split_ipd(raw)
+            if not text:
+                continue
+            searched = max(0, len(response) - 16)  # needles are shorter
+            response += text
+            for needle in needles:
+                index = response.find(needle, searched)
+                if index >= 0:
+                    if cut:
+                        index += len(needle)
+                        self._urc_buf += response[index:]
+                        response = response[:index]
+                    self._urc_buf += raw
+                    if self._debug:
+                        print("<---", response)
+                    self._scan_urc(response)
+                    return response
+        self._urc_buf += raw
+        if self._debug:
+            print("<---", response)
+        self._scan_urc(response)
+        return response
+
+    def _split_ipd(self, raw: bytes) -> Tuple[bytes, bytes]:
+        """Move the +IPD frames in 'raw' into _rx_pending. Returns the other
+        bytes, and the tail that may still turn into a +IPD frame"""
+        text = b""
+        while raw:
+            if self._ipd_remaining:
+                take = min(self._ipd_remaining, len(raw))
+                self._rx_pending += raw[:take]
+                self._ipd_remaining -= take
+                raw = raw[take:]
+                continue
+            ipd = raw.find(b"+IPD,")
+            if ipd < 0:
+                # hold back what could be the start of a +IPD header
+                keep = 0
+                for size in range(min(4, len(raw)), 0, -1):
+                    if raw.endswith(b"+IPD,"[:size]):
+                        keep = size
+                        break
+                text += raw[: len(raw) - keep]
+                return text, raw[len(raw) - keep :]
+            text += raw[:ipd]
+            raw = raw[ipd:]
+            colon = raw.find(b":")
+            if colon < 0:
+                if len(raw) > 20:
+                    text += raw[:5]  # not a real +IPD header
+                    raw = raw[5:]
+                    continue
+                break
+            try:
+                self._ipd_remaining = int(raw[5:colon].split(b",")[-1])
+            except ValueError:
+                self._ipd_remaining = 0
+            raw = raw[colon + 1 :]
+        return text, raw
+
+    def at_batch(self, cmds: List[str], timeout: int = 3) -> bool:
+        """Send several AT commands, each as soon as the previous one answered,
+        without at_response()'s fixed delays. True if all of them got OK"""
+        self._flush()
+        for cmd in cmds:
+            self._at_write(cmd)
+            reply = self._read_until((b"OK\r\n", b"ERROR\r\n", b"FAIL\r\n"), timeout)
+            if b"OK\r\n" not in reply or b"ERROR\r\n" in reply or b"FAIL\r\n" in reply:
+                return False
+        return True
+
     def hw_flow(self, flag: bool) -> None:
         """Turn on HW flow control (if available) on to allow data, or off to stop"""
         #if self._rts_pin:
@@ -567,8 +887,7 @@ class WizFi_ATcontrol:
             if self._debug:
                 print("--->", at_cmd)
             
-            while self._uart.any(): #flush uart buff before w/r command
-                self._uart.read(1)                
+            self._flush() #flush uart buff before w/r command
             self._uart.write(bytes(at_cmd, "utf-8"))
             self._uart.write(b"\x0d\x0a")
             time.sleep(0.1)  # wait for uart data
@@ -611,6 +930,7 @@ class WizFi_ATcontrol:
             # eat beginning \n and \r
             if self._debug:
                 print("<---", response)
+            self._scan_urc(response)
             # special case, AT+CIPSEND= return an OK>
             if "AT+CIPSEND=" in at_cmd and b">" in response:
                 return response
@@ -704,6 +1024,7 @@ class WizFi_ATcontrol:
             self._reset_pin.value(True)
             time.sleep(5)  # give it a few seconds to wake up
             self._initialized = False
+            self._dhcp_enabled = True
 
     def deep_sleep(self, duration_ms: int) -> bool:
         """Execute deep-sleep command.
@@ -746,57 +1067,65 @@ class WizFi_ATcontrol:
         
         try:
             self.at_response(cmd, retries=1)
+            self._mqtt_config["AT+MQTTSET"] = cmd
             return True
         except OKError:
             return False
 
-    #only wifi360 1.1.1.8
     def mqtt_set_qos(self, qos: int=0) -> bool:
-        """ Sets the Configuration of publish QoS. """
+        """ Sets the Configuration of publish QoS. Needs AT firmware 1.1.1.8,
+        older firmware always publishes with QoS 0 """
+        if not self.has_feature("mqtt_qos"):
+            return qos == 0
         cmd = "AT+MQTTQOS=" + str(qos)
         
         try:
             ret=self.at_response(cmd, retries=1)
+            self._mqtt_config["AT+MQTTQOS"] = cmd
             return True
         except OKError:
             return False
 
     # AT+MQTTTOPIC
-    def mqtt_set_topic(self, publish_topic: str, sub_topic: str) -> bool:
-        """ Registers a MQTT topics."""
-
-        cmd = "AT+MQTTTOPIC=" + '"'+str(publish_topic)+ '","' + str(sub_topic)+ '"'
-        
-        """
-        sub_cnt= 0
-        
-        while sub_cnt< SUB_CNT_MAX:
-            if None==sub_topic[sub_cnt]:
-                break
-            else:
-                #self._mqtt_sub_topic[sub_cnt]= sub_topic[sub_cnt]
-                cmd += ',"' + sub_topic[sub_cnt] + '"'
-                sub_cnt+1
-        if  sub_cnt ==0:  
+    def mqtt_set_topic(self, publish_topic: str, sub_topic: Union[str, List[str]]) -> bool:
+        """ Registers a MQTT topics. 'sub_topic' may be a list of up to
+        SUB_CNT_MAX subscription topics."""
+        if isinstance(sub_topic, str):
+            sub_topic = [sub_topic]
+        if not sub_topic:
             print("Error: None subtopics")
             return False
-        """
+        if len(sub_topic) > SUB_CNT_MAX:
+            raise ValueError("At most %d subscription topics" % SUB_CNT_MAX)
+        cmd = "AT+MQTTTOPIC=" + '"' + str(publish_topic) + '"'
+        for topic in sub_topic:
+            cmd += ',"' + str(topic) + '"'
         try:
             self.at_response(cmd, retries=1)
+            self._mqtt_config["AT+MQTTTOPIC"] = cmd
             return True
         except OKError:
             return False
 
+    def mqtt_restore(self, timeout: int = 3) -> bool:
+        """Send the last user info, topic and QoS configuration again, back to
+        back, e.g. after the module was reset"""
+        cmds = []
+        for key in ("AT+MQTTSET", "AT+MQTTTOPIC", "AT+MQTTQOS"):
+            if key in self._mqtt_config:
+                cmds.append(self._mqtt_config[key])
+        return self.at_batch(cmds, timeout)
+
     # AT+MQTTCON
-    def mqtt_connect(self, auth_enable:int, broker_ip: str, broker_port: int, link_id: Optional[int] = None) -> bool:
-        """Initiates connection with the MQTT Broker."""
+    def mqtt_connect(self, auth_enable:int, broker_ip: str, broker_port: int, link_id: Optional[int] = None, retries: int = 3) -> bool:
+        """Initiates connection with the MQTT Broker, trying up to 'retries' times."""
         
         if not link_id:
             cmd = "AT+MQTTCON=" + str(auth_enable) + ',"' + str(broker_ip) + '",' + str(broker_port)
         else:
             cmd = "AT+MQTTCON=" + str(link_id) + "," + str(auth_enable) + ',"' + str(broker_ip) + '",' + str(broker_port)
         try:
-            self.at_response(cmd, timeout=100, retries=3)
+            self.at_response(cmd, timeout=100, retries=retries)
             self.is_mqtt_conn=True
             
             return True
@@ -818,95 +1147,88 @@ class WizFi_ATcontrol:
 
 
     # AT+MQTTPUB & AT+MQTTPUBSEND
-    def mqtt_publish(self, message: bytes, timeout: int = 50) -> bool:
-        """Publishes a message to a topic provided."""
-
-        cmd = "AT+MQTTPUB=" + '"' + str(message) + '"'
+    def mqtt_publish(self, message: Union[str, bytes], timeout: int = 5) -> bool:
+        """Publishes a message to the configured topic. If the firmware has
+        AT+MQTTPUBSEND (1.1.1.8) the payload goes out length-prefixed as raw
+        bytes, otherwise it is quoted into AT+MQTTPUB and must be text"""
+        if self.has_feature("mqtt_pubsend"):
+            if isinstance(message, str):
+                message = message.encode("utf-8")
+            return self.mqtt_publish_binary(message, timeout)
+        if not isinstance(message, str):
+            try:
+                message = str(message, "utf-8")
+            except UnicodeError as err:
+                raise ValueError("Binary payloads need AT+MQTTPUBSEND") from err
+        if "\r" in message or "\n" in message:
+            raise ValueError("Line breaks need AT+MQTTPUBSEND")
+        # escape the characters the AT parser treats as special
+        for char in ("\\", '"', ","):
+            if char in message:
+                message = message.replace(char, "\\" + char)
+        cmd = 'AT+MQTTPUB="' + message + '"'
         try:
-            self.at_response(cmd, retries=1)
+            self.at_response(cmd, timeout=timeout, retries=1)
             return True
         except OKError:
             return False
-        """
-        #only wifi360 1.1.1.8
-        cmd = "AT+MQTTPUBSEND=%d" % len(message)
-        self.at_response(cmd, timeout=5, retries=1)
-
-        prompt = b""
-        stamp = time.ticks_ms()/1000
-        while time.ticks_diff (time.ticks_ms()/1000, stamp) < timeout:
-            stamp = time.ticks_ms()/1000
-            if self._uart.any():
-                prompt += self._uart.read(1)
-                self.hw_flow(False)
-                # print(prompt)
-                if prompt[-1:] == b">":
-                    break
-                else:
-                    self.hw_flow(True)
-
-        if not prompt or (prompt[-1:] != b">"):
-            raise RuntimeError("Didn't get data prompt for sending")
-
-        self._uart.write(message)    
 
-        response = b""        
-        stamp = time.ticks_ms()/1000
-        while time.ticks_diff (time.ticks_ms()/1000, stamp) < timeout:
-            if self._uart.any():
-                prompt += self._uart.read(1)
+    def mqtt_publish_binary(self, message: bytes, timeout: int = 5) -> bool:
+        """Publishes raw bytes (any buffer) with AT+MQTTPUBSEND=<len>, waiting
+        for the '>' prompt and then writing the payload straight from a
+        memoryview. Only on AT firmware 1.1.1.8 and newer"""
+        payload = memoryview(message)
+        self._flush()
+        self._at_write("AT+MQTTPUBSEND=%d" % len(payload))
+        prompt = self._read_until((b">", b"ERROR\r\n"), timeout)
+        if b">" not in prompt:
+            return False
+        self._uart.write(payload)
+        response = self._read_until((b"OK\r\n", b"ERROR\r\n"), timeout)
+        return b"OK\r\n" in response
+
+    @staticmethod
+    def parse_mqtt_message(line: bytes) -> Union[tuple, None]:
+        """Split a received-message line 'topic -> payload' into
+        (topic, payload) bytes, or None if it isn't one"""
+        index = line.find(WIZFI360_MQTT_SEPARATOR)
+        if index <= 0:
+            return None
+        return (bytes(line[:index]), bytes(line[index + 4 :]))
+
+    def mqtt_subscribe(self, subtopic: str, timeout: int = 20) -> Union[bytes, None]:
+        """Wait up to 'timeout' seconds for a message on 'subtopic' and return
+        its payload, or None. Messages for other topics still reach the other
+        URC handlers (see MQTTDispatcher for a non-blocking receiver)"""
+        subtopic = bytes(subtopic, "utf-8")
+        received = []
+
+        def handler(line):
+            message = self.parse_mqtt_message(line)
+            if message and message[0] == subtopic and not received:
+                received.append(message)
+                return True
+            return False
 
-                if response[-4:] == b"OK\r\n":
-                    break
-                if response[-7:] == b"ERROR\r\n":
-                    break
-        if self._debug:
-            print("<---", response)
-        # Get newlines off front and back, then split into lines
-        return True
-    """
-    
-    def mqtt_subscribe(self, subtopic: bytes, timeout: int = 20) -> bytearray:
-        mqtt_start_msg= b""
-        mqtt_packet_msg= b""
-        recv_sub_num= -1
-        i=0
-        subtopic= bytes(subtopic, "utf-8")
-
-        stamp = time.ticks_ms()       
-        while time.ticks_diff (time.ticks_ms(), stamp) < timeout:
-            if self._uart.any()>0:
-                stamp = time.ticks_ms()
-                
-                if recv_sub_num<0:                    
-                    # look for the start point that after ' -> '    
-                    if mqtt_start_msg[i-4:i] != b" -> ":
-                        mqtt_start_msg+= self._uart.read(1)
-                        i+=1
-                        continue
-                    
-                    # look for received subTopic
-                    # add. find matched subtopic
-                    # print(">>start message is: ", mqtt_start_msg)
-                    if mqtt_start_msg[:i-4] == subtopic:
-                        self._mqtt_topic_msg=mqtt_start_msg[:i-4]
-                        recv_sub_num=1 
-                    else:
-                        print("not matthed subtopic: ", mqtt_start_msg[:i-4],"/",
-                              subtopic)
-                        return None
-                else:
-                    mqtt_packet_msg += self._uart.read(1)                    
-            
-        if recv_sub_num <0:
+        # ahead of the other handlers so a dispatcher doesn't swallow it
+        self._urc_handlers.insert(0, handler)
+        try:
+            timeout_ms = int(timeout * 1000)
+            stamp = time.ticks_ms()
+            while not received and time.ticks_diff(time.ticks_ms(), stamp) < timeout_ms:
+                if not self.poll_urc():
+                    time.sleep_ms(1)
+        finally:
+            self.remove_urc_handler(handler)
+        if not received:
             return None
-        self._mqtt_packet_msg= mqtt_packet_msg
-        print("recv", self._mqtt_topic_msg, "/", self._mqtt_packet_msg)
-        return None
-                
+        self._mqtt_topic_msg, self._mqtt_packet_msg = received[0]
+        return self._mqtt_packet_msg
 
-        
     def fw_update(self):
         self.at_response("AT+CIUPDATE", timeout=300, retries=1)
         time.sleep(1)
+        # new firmware, new features
+        self._version_tuple = None
+        self.features = {}
         
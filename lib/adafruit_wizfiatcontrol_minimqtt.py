@@ -0,0 +1,457 @@
+# SPDX-FileCopyrightText: 2019 Brent Rubell for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_wizfiatcontrol_minimqtt`
+====================================================
+
+A small MQTT 3.1.1 client that frames packets itself and talks to the broker
+through the 'socket' compatible interface of adafruit_wizfiatcontrol_socket,
+instead of the WizFi360 firmware MQTT commands. Topics are per message,
+QoS 0 and 1 are supported with several QoS 1 publishes in flight at once.
+
+Command set:
+https://docs.wiznet.io/Product/Wi-Fi-Module/WizFi360/documents#at-instruction-set
+
+* Author(s): WIZnet
+
+Implementation Notes
+--------------------
+
+**Hardware:**
+
+* WIZnet `WizFi360-EVB-Pico
+  <https://docs.wiznet.io/Product/Open-Source-Hardware/wizfi360-evb-pico>`
+
+**Software and Dependencies:**
+
+* Reference software:
+  https://github.com/Wiznet/WizFi360-EVB-Pico-MicroPython
+
+"""
+
+import errno
+import time
+from adafruit_wizfiatcontrol_mqtt import topic_matches
+
+try:
+    from typing import Any, Callable, Optional, Union
+except ImportError:
+    pass
+
+MQTT_CONNECT = 0x10
+MQTT_CONNACK = 0x20
+MQTT_PUBLISH = 0x30
+MQTT_PUBACK = 0x40
+MQTT_SUBSCRIBE = 0x82
+MQTT_SUBACK = 0x90
+MQTT_UNSUBSCRIBE = 0xA2
+MQTT_UNSUBACK = 0xB0
+MQTT_PINGREQ = 0xC0
+MQTT_PINGRESP = 0xD0
+MQTT_DISCONNECT = 0xE0
+
+CONNACK_ERRORS = {
+    1: "Unacceptable protocol version",
+    2: "Client identifier rejected",
+    3: "Server unavailable",
+    4: "Bad user name or password",
+    5: "Not authorized",
+}
+
+
+class MQTTException(Exception):
+    """MiniMQTT exception class."""
+
+
+class MQTT:
+    """MQTT client over the WizFi360 socket interface.
+
+    :param socket_pool: Anything with 'socket()', such as the
+        adafruit_wizfiatcontrol_socket module
+    :param str broker: Broker IP address or host name
+    :param int port: Broker port
+    :param str client_id: Client identifier
+    :param str username: (Optional) User name
+    :param str password: (Optional) Password
+    :param int keep_alive: Keep alive interval in seconds
+    :param bool is_ssl: Connect with SSL
+    :param int max_inflight: How many QoS 1 publishes may wait for PUBACK
+    :param int buffer_size: Size of the preallocated packet buffers
+    """
+
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+
+    def __init__(
+        self,
+        socket_pool: Any,
+        broker: str,
+        port: int = 1883,
+        client_id: str = "",
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        keep_alive: int = 60,
+        is_ssl: bool = False,
+        max_inflight: int = 8,
+        buffer_size: int = 512,
+        retry_timeout: int = 5,
+    ) -> None:
+        self._pool = socket_pool
+        self.broker = broker
+        self.port = port
+        self.client_id = client_id
+        self._username = username
+        self._password = password
+        self.keep_alive = keep_alive
+        self._is_ssl = is_ssl
+        self._max_inflight = max_inflight
+        self._retry_ms = retry_timeout * 1000
+        self._out = bytearray(buffer_size)
+        self._in = bytearray(buffer_size)
+        self._sock = None
+        self._pid = 0
+        self._inflight = {}
+        self._acks = {}
+        self._subscriptions = {}
+        self._last_send = time.ticks_ms()
+        self._last_recv = time.ticks_ms()
+        self._ping_sent = None
+        self.on_message = None
+        self.timeout = 10
+
+    @property
+    def is_connected(self) -> bool:
+        """True while we have a broker connection"""
+        return self._sock is not None
+
+    @property
+    def inflight(self) -> int:
+        """QoS 1 publishes still waiting for PUBACK"""
+        return len(self._inflight)
+
+    # ************************** PACKET FRAMING ****************************
+
+    def _header(self, first_byte: int, remaining: int) -> int:
+        """Write the fixed header into the out buffer, returns its length"""
+        buf = self._out
+        buf[0] = first_byte
+        i = 1
+        while True:
+            byte = remaining & 0x7F
+            remaining >>= 7
+            if remaining:
+                byte |= 0x80
+            buf[i] = byte
+            i += 1
+            if not remaining:
+                return i
+
+    def _put_string(self, i: int, data: bytes) -> int:
+        """Write a 2-byte length prefixed string, returns the new offset"""
+        size = len(data)
+        if i + 2 + size > len(self._out):
+            raise MQTTException("Packet larger than buffer_size")
+        self._out[i] = size >> 8
+        self._out[i + 1] = size & 0xFF
+        self._out[i + 2 : i + 2 + size] = data
+        return i + 2 + size
+
+    def _put_int(self, i: int, value: int) -> int:
+        self._out[i] = value >> 8
+        self._out[i + 1] = value & 0xFF
+        return i + 2
+
+    def _send(self, data: Union[bytes, memoryview]) -> None:
+        if not self._sock:
+            raise MQTTException("Not connected")
+        try:
+            self._sock.send(data)
+        except (OSError, RuntimeError) as error:
+            self._drop_connection()
+            raise MQTTException("Send failed") from error
+        self._last_send = time.ticks_ms()
+
+    def _send_out(self, length: int) -> None:
+        self._send(memoryview(self._out)[:length])
+
+    def _next_pid(self) -> int:
+        while True:
+            self._pid = self._pid % 0xFFFF + 1
+            if self._pid not in self._inflight:
+                return self._pid
+
+    @staticmethod
+    def _encode(text: Union[str, bytes]) -> bytes:
+        if isinstance(text, str):
+            return text.encode("utf-8")
+        return text
+
+    # ************************** PACKET READING ****************************
+
+    def _recv(self, size: int) -> Optional[bytes]:
+        """Non-blocking read, None if nothing has arrived yet"""
+        try:
+            data = self._sock.recv(size)
+        except OSError as error:
+            if error.args[0] in (errno.EAGAIN, errno.ETIMEDOUT):
+                return None
+            raise
+        if not data:
+            self._drop_connection()
+            raise MQTTException("Connection closed by broker")
+        return data
+
+    def _recv_exact(self, buf: memoryview, size: int) -> None:
+        """Fill buf[:size] from the socket or raise after self.timeout"""
+        got = 0
+        stamp = time.ticks_ms()
+        while got < size:
+            data = self._recv(size - got)
+            if data:
+                buf[got : got + len(data)] = data
+                got += len(data)
+                stamp = time.ticks_ms()
+            elif time.ticks_diff(time.ticks_ms(), stamp) > self.timeout * 1000:
+                self._drop_connection()
+                raise MQTTException("Timed out reading from broker")
+
+    def _read_packet(self) -> Optional[int]:
+        """Read and handle one packet if there is one. Returns its type"""
+        first = self._recv(1)
+        if not first:
+            return None
+        byte = bytearray(1)
+        remaining = 0
+        shift = 0
+        while True:
+            self._recv_exact(memoryview(byte), 1)
+            remaining |= (byte[0] & 0x7F) << shift
+            shift += 7
+            if not byte[0] & 0x80:
+                break
+        body = self._in if remaining <= len(self._in) else bytearray(remaining)
+        body = memoryview(body)
+        self._recv_exact(body, remaining)
+        self._last_recv = time.ticks_ms()
+        self._handle(first[0], body[:remaining])
+        return first[0] & 0xF0
+
+    def _handle(self, first_byte: int, body: memoryview) -> None:
+        packet_type = first_byte & 0xF0
+        if packet_type == MQTT_PUBLISH:
+            qos = (first_byte >> 1) & 0x03
+            topic_len = (body[0] << 8) | body[1]
+            topic = str(bytes(body[2 : 2 + topic_len]), "utf-8")
+            i = 2 + topic_len
+            if qos:
+                pid = (body[i] << 8) | body[i + 1]
+                i += 2
+            payload = bytes(body[i:])
+            if qos:
+                self._send(bytes((MQTT_PUBACK, 2, pid >> 8, pid & 0xFF)))
+            self._deliver(topic, payload)
+        elif packet_type == MQTT_PUBACK:
+            self._inflight.pop((body[0] << 8) | body[1], None)
+        elif packet_type in (MQTT_SUBACK, MQTT_UNSUBACK, MQTT_CONNACK):
+            # for CONNACK the "packet id" is (session present, return code)
+            pid = (body[0] << 8) | body[1]
+            self._acks[packet_type] = (pid, bytes(body[2:]))
+        elif packet_type == MQTT_PINGRESP:
+            self._ping_sent = None
+
+    def _deliver(self, topic: str, payload: bytes) -> None:
+        delivered = False
+        for topic_filter, callback in self._subscriptions.items():
+            if callback and topic_matches(topic_filter, topic):
+                callback(self, topic, payload)
+                delivered = True
+        if not delivered and self.on_message:
+            self.on_message(self, topic, payload)
+
+    def _wait_for(self, packet_type: int, pid: int = 0) -> bytes:
+        """Handle packets until the ack 'packet_type' for 'pid' shows up"""
+        stamp = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), stamp) < self.timeout * 1000:
+            ack = self._acks.pop(packet_type, None)
+            if ack and ack[0] == pid:
+                return ack[1]
+            if self._sock is None:
+                break
+            self._read_packet()
+        raise MQTTException("No response from broker")
+
+    # ************************** CLIENT API ****************************
+
+    def connect(self, clean_session: bool = True) -> None:
+        """Open the socket and send CONNECT, waiting for CONNACK"""
+        sock = self._pool.socket()
+        sock.settimeout(0)
+        sock.connect((self.broker, self.port), "SSL" if self._is_ssl else "TCP")
+        self._sock = sock
+        self._acks = {}
+        client_id = self._encode(self.client_id)
+        flags = 0x02 if clean_session else 0
+        size = 10 + 2 + len(client_id)
+        if self._username is not None:
+            flags |= 0x80
+            size += 2 + len(self._encode(self._username))
+        if self._password is not None:
+            flags |= 0x40
+            size += 2 + len(self._encode(self._password))
+        i = self._header(MQTT_CONNECT, size)
+        i = self._put_string(i, b"MQTT")
+        self._out[i] = 4  # protocol level 3.1.1
+        self._out[i + 1] = flags
+        i = self._put_int(i + 2, self.keep_alive)
+        i = self._put_string(i, client_id)
+        if self._username is not None:
+            i = self._put_string(i, self._encode(self._username))
+        if self._password is not None:
+            i = self._put_string(i, self._encode(self._password))
+        self._send_out(i)
+        return_code = self._wait_connack()
+        if return_code:
+            self._drop_connection()
+            raise MQTTException(CONNACK_ERRORS.get(return_code, "Connection refused"))
+        # resend unacknowledged publishes on the next loop()
+        resend = time.ticks_add(time.ticks_ms(), -self._retry_ms)
+        for pid in self._inflight:
+            self._inflight[pid][3] = resend
+
+    def _wait_connack(self) -> int:
+        """Handle packets until CONNACK, returns its return code"""
+        stamp = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), stamp) < self.timeout * 1000:
+            ack = self._acks.pop(MQTT_CONNACK, None)
+            if ack:
+                return ack[0] & 0xFF
+            self._read_packet()
+        self._drop_connection()
+        raise MQTTException("No CONNACK from broker")
+
+    def disconnect(self) -> None:
+        """Send DISCONNECT and close the socket"""
+        if self._sock:
+            try:
+                self._send(bytes((MQTT_DISCONNECT, 0)))
+            except MQTTException:
+                pass
+        self._drop_connection()
+
+    def _drop_connection(self) -> None:
+        sock = self._sock
+        self._sock = None
+        if sock:
+            try:
+                sock.close()
+            except (OSError, RuntimeError):
+                pass
+
+    def publish(
+        self,
+        topic: str,
+        payload: Union[str, bytes],
+        qos: int = 0,
+        retain: bool = False,
+    ) -> Optional[int]:
+        """Publish to any topic. QoS 1 publishes are pipelined: we only wait
+        when 'max_inflight' of them are still unacknowledged. Returns the
+        packet id for QoS 1"""
+        if qos not in (0, 1):
+            raise MQTTException("Only QoS 0 and 1 are supported")
+        while qos and len(self._inflight) >= self._max_inflight:
+            if not self.loop():
+                self._wait_any()
+        topic = self._encode(topic)
+        payload = self._encode(payload)
+        pid = self._next_pid() if qos else 0
+        self._publish(topic, payload, qos, retain, pid, False)
+        if qos:
+            self._inflight[pid] = [topic, payload, retain, time.ticks_ms()]
+            return pid
+        return None
+
+    def _wait_any(self) -> None:
+        stamp = time.ticks_ms()
+        while self._read_packet() is None:
+            if time.ticks_diff(time.ticks_ms(), stamp) > self.timeout * 1000:
+                raise MQTTException("No PUBACK from broker")
+
+    def _publish(
+        self, topic: bytes, payload: bytes, qos: int, retain: bool, pid: int, dup: bool
+    ) -> None:
+        first_byte = MQTT_PUBLISH | (qos << 1) | (0x08 if dup else 0) | int(retain)
+        size = 2 + len(topic) + (2 if qos else 0)
+        i = self._header(first_byte, size + len(payload))
+        i = self._put_string(i, topic)
+        if qos:
+            i = self._put_int(i, pid)
+        if i + len(payload) <= len(self._out):
+            # small enough to go out in one send
+            self._out[i : i + len(payload)] = payload
+            self._send_out(i + len(payload))
+        else:
+            self._send_out(i)
+            self._send(payload)
+
+    def subscribe(
+        self,
+        topic_filter: str,
+        qos: int = 0,
+        callback: Optional[Callable[[Any, str, bytes], None]] = None,
+    ) -> None:
+        """Subscribe and wait for SUBACK. Messages matching 'topic_filter' go
+        to 'callback(client, topic, payload)', otherwise to on_message"""
+        encoded = self._encode(topic_filter)
+        pid = self._next_pid()
+        i = self._header(MQTT_SUBSCRIBE, 2 + 2 + len(encoded) + 1)
+        i = self._put_int(i, pid)
+        i = self._put_string(i, encoded)
+        self._out[i] = min(qos, 1)
+        self._send_out(i + 1)
+        granted = self._wait_for(MQTT_SUBACK, pid)
+        if not granted or granted[0] == 0x80:
+            raise MQTTException("Subscription to %s refused" % topic_filter)
+        self._subscriptions[topic_filter] = callback
+
+    def unsubscribe(self, topic_filter: str) -> None:
+        """Unsubscribe and wait for UNSUBACK"""
+        encoded = self._encode(topic_filter)
+        pid = self._next_pid()
+        i = self._header(MQTT_UNSUBSCRIBE, 2 + 2 + len(encoded))
+        i = self._put_int(i, pid)
+        i = self._put_string(i, encoded)
+        self._send_out(i)
+        self._wait_for(MQTT_UNSUBACK, pid)
+        self._subscriptions.pop(topic_filter, None)
+
+    def ping(self) -> None:
+        """Send PINGREQ, the answer is handled by loop()"""
+        self._send(bytes((MQTT_PINGREQ, 0)))
+        self._ping_sent = time.ticks_ms()
+
+    def loop(self) -> int:
+        """Handle every packet the broker has sent, resend QoS 1 publishes
+        that weren't acknowledged in time and ping only if we've been idle.
+        Returns the number of packets handled"""
+        if not self._sock:
+            raise MQTTException("Not connected")
+        count = 0
+        while self._read_packet() is not None:
+            count += 1
+            if not self._sock:
+                return count
+        now = time.ticks_ms()
+        for pid, message in self._inflight.items():
+            if time.ticks_diff(now, message[3]) >= self._retry_ms:
+                self._publish(message[0], message[1], 1, message[2], pid, True)
+                message[3] = now
+        keep_alive_ms = self.keep_alive * 1000
+        if self._ping_sent is not None:
+            if time.ticks_diff(now, self._ping_sent) > keep_alive_ms:
+                self._drop_connection()
+                raise MQTTException("Broker stopped answering PINGREQ")
+        elif keep_alive_ms and time.ticks_diff(now, self._last_send) >= keep_alive_ms * 3 // 4:
+            self.ping()
+        return count
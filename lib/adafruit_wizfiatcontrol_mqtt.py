@@ -0,0 +1,545 @@
+# SPDX-FileCopyrightText: 2018 ladyada for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""
+`adafruit_wizfiatcontrol_mqtt`
+====================================================
+
+Helpers on top of the WizFi360 firmware MQTT client (AT+MQTTSET/TOPIC/CON/PUB)
+
+Command set:
+https://docs.wiznet.io/Product/Wi-Fi-Module/WizFi360/documents#at-instruction-set
+
+* Author(s): WIZnet
+
+Implementation Notes
+--------------------
+
+**Hardware:**
+
+* WIZnet `WizFi360-EVB-Pico
+  <https://docs.wiznet.io/Product/Open-Source-Hardware/wizfi360-evb-pico>`
+
+**Software and Dependencies:**
+
+* Reference software:
+  https://github.com/Wiznet/WizFi360-EVB-Pico-MicroPython
+
+"""
+
+import os
+import random
+import time
+from adafruit_wizfiatcontrol import SUB_CNT_MAX, OKError
+
+try:
+    from typing import Callable, Dict, List, Optional, Tuple, Union
+    from adafruit_wizfiatcontrol import WizFi_ATcontrol
+except ImportError:
+    pass
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Check a topic against an MQTT filter, '+' matches one level and '#'
+    matches all remaining levels"""
+    if topic_filter == topic:
+        return True
+    if topic.startswith("$") and topic_filter[:1] in ("+", "#"):
+        return False  # wildcards don't match $SYS and friends
+    filters = topic_filter.split("/")
+    levels = topic.split("/")
+    for i, part in enumerate(filters):
+        if part == "#":
+            return True
+        if i >= len(levels):
+            return False
+        if part not in ("+", levels[i]):
+            return False
+    return len(filters) == len(levels)
+
+
+class _Backoff:
+    """Jittered exponential backoff, all times in milliseconds"""
+
+    def __init__(self, initial: int = 1000, maximum: int = 60000) -> None:
+        self._initial = initial
+        self._maximum = maximum
+        self.delay = 0
+        self.failures = 0
+        self._stamp = time.ticks_ms()
+
+    def reset(self) -> None:
+        """Succeeded, go again right away next time"""
+        self.delay = 0
+        self.failures = 0
+
+    def fail(self) -> None:
+        """Failed, wait longer (between half and all of the next step)"""
+        self.failures += 1
+        step = min(self._maximum, self._initial << min(self.failures - 1, 16))
+        self.delay = step // 2 + (random.getrandbits(16) * (step - step // 2) >> 16)
+        self._stamp = time.ticks_ms()
+
+    def ready(self) -> bool:
+        """True once the current delay has passed"""
+        return time.ticks_diff(time.ticks_ms(), self._stamp) >= self.delay
+
+
+class MQTTDispatcher:
+    """Non-blocking receiver for the firmware MQTT subscriptions. Messages are
+    parsed out of the module's unsolicited output and handed to the callback
+    of every matching topic filter, or queued as (topic, payload) for filters
+    registered without a callback"""
+
+    def __init__(self, wizfi: WizFi_ATcontrol, queue_size: int = 16) -> None:
+        """
+        :param WizFi_ATcontrol wizfi: The WizFi360 object we are using
+        :param int queue_size: How many messages to hold for get() before
+            dropping the oldest
+        """
+        self._wizfi = wizfi
+        self._subscriptions = []
+        self._queue = []
+        self._queue_size = queue_size
+        self.received = 0
+        self.dropped = 0
+        wizfi.add_urc_handler(self._on_line)
+
+    def subscribe(
+        self, topic_filter: str, callback: Optional[Callable[[str, bytes], None]] = None
+    ) -> None:
+        """Deliver messages matching 'topic_filter' to 'callback(topic, payload)',
+        or to the queue read by get() if there is no callback"""
+        for subscription in self._subscriptions:
+            if subscription[0] == topic_filter:
+                subscription[1] = callback
+                return
+        if len(self._subscriptions) >= SUB_CNT_MAX:
+            raise ValueError("At most %d subscription topics" % SUB_CNT_MAX)
+        self._subscriptions.append([topic_filter, callback])
+
+    def unsubscribe(self, topic_filter: str) -> None:
+        """Stop delivering messages for 'topic_filter'"""
+        for subscription in self._subscriptions:
+            if subscription[0] == topic_filter:
+                self._subscriptions.remove(subscription)
+                return
+
+    @property
+    def topics(self) -> List[str]:
+        """The topic filters we are subscribed to"""
+        return [subscription[0] for subscription in self._subscriptions]
+
+    def register(self, publish_topic: str) -> bool:
+        """Send all our topic filters to the module with AT+MQTTTOPIC.
+        Must be done before mqtt_connect()"""
+        return self._wizfi.mqtt_set_topic(publish_topic, self.topics)
+
+    def poll(self) -> int:
+        """Handle whatever the module has sent so far without waiting.
+        Returns the number of messages received"""
+        before = self.received
+        self._wizfi.poll_urc()
+        return self.received - before
+
+    def get(self) -> Optional[Tuple[str, bytes]]:
+        """The oldest queued (topic, payload), or None"""
+        if not self._queue:
+            return None
+        return self._queue.pop(0)
+
+    @property
+    def pending(self) -> int:
+        """How many messages are waiting in the queue"""
+        return len(self._queue)
+
+    def close(self) -> None:
+        """Stop listening to the module"""
+        self._wizfi.remove_urc_handler(self._on_line)
+
+    def _on_line(self, line: bytes) -> bool:
+        message = self._wizfi.parse_mqtt_message(line)
+        if not message:
+            return False
+        topic = str(message[0], "utf-8")
+        payload = message[1]
+        matched = False
+        queue = False
+        for topic_filter, callback in self._subscriptions:
+            if not topic_matches(topic_filter, topic):
+                continue
+            matched = True
+            if callback:
+                callback(topic, payload)
+            else:
+                queue = True
+        if not matched:
+            return False
+        self.received += 1
+        if queue:
+            if len(self._queue) >= self._queue_size:
+                self._queue.pop(0)
+                self.dropped += 1
+            self._queue.append((topic, payload))
+        return True
+
+
+class PublishQueue:
+    """Store-and-forward wrapper around mqtt_publish(). publish() only queues
+    the message, service() (called from the main loop) reconnects with
+    backoff and sends what's queued, joining several queued messages into
+    one publish when it can. When RAM is full the oldest messages move to a
+    flash file, and when that is full too 'drop_policy' decides: "oldest"
+    drops the oldest message in RAM, "newest" refuses the new one. How far
+    the flash file has been sent is kept in 'spill_path'.off, so a reset
+    doesn't send those messages again"""
+
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+
+    def __init__(
+        self,
+        wizfi: WizFi_ATcontrol,
+        broker_ip: str,
+        broker_port: int = 1883,
+        auth_enable: int = 0,
+        *,
+        max_messages: int = 32,
+        spill_path: Optional[str] = None,
+        max_spill_bytes: int = 16384,
+        drop_policy: str = "oldest",
+        separator: Optional[bytes] = b"\n",
+        max_batch_bytes: int = 512,
+        backoff_ms: int = 1000,
+        max_backoff_ms: int = 60000
+    ) -> None:
+        """
+        :param WizFi_ATcontrol wizfi: The WizFi360 object we are using
+        :param str broker_ip: Broker to (re)connect to with mqtt_connect()
+        :param int max_messages: How many messages to hold in RAM
+        :param str spill_path: (Optional) File for messages that don't fit in RAM
+        :param int max_spill_bytes: Largest size of the spill file
+        :param str drop_policy: "oldest" or "newest"
+        :param bytes separator: Joins queued messages into one publish,
+            None to publish each message on its own
+        :param int max_batch_bytes: Largest joined publish
+        """
+        if drop_policy not in ("oldest", "newest"):
+            raise ValueError("drop_policy must be 'oldest' or 'newest'")
+        self._wizfi = wizfi
+        self._broker = (auth_enable, broker_ip, broker_port)
+        self._queue = []
+        self._max_messages = max_messages
+        self._spill_path = spill_path
+        self._max_spill_bytes = max_spill_bytes
+        self._spill_offset = 0
+        self._spill_end = 0
+        self._spill_count = 0
+        self._drop_policy = drop_policy
+        self._separator = separator
+        self._max_batch_bytes = max_batch_bytes
+        self._backoff = _Backoff(backoff_ms, max_backoff_ms)
+        self.sent = 0
+        self.publishes = 0
+        self.dropped = 0
+        self.spilled = 0
+        if spill_path:
+            self._load_spill()
+
+    @property
+    def pending(self) -> int:
+        """Messages waiting in RAM and on flash"""
+        return len(self._queue) + self._spill_count
+
+    def publish(self, message: bytes) -> bool:
+        """Queue a message, never blocks. Returns False if it was dropped"""
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        if len(self._queue) >= self._max_messages:
+            if not self._spill(self._queue[0]):
+                self.dropped += 1
+                if self._drop_policy == "newest":
+                    return False
+            self._queue.pop(0)
+        self._queue.append(bytes(message))
+        return True
+
+    def service(self, max_publishes: int = 4) -> int:
+        """Reconnect if needed and it's time to, then send up to
+        'max_publishes' publish commands. Returns how many messages went out"""
+        sent = 0
+        if not self.pending:
+            return 0
+        if not self._wizfi.is_mqtt_conn:
+            if not self._backoff.ready():
+                return 0
+            # one attempt, the backoff spaces out the next ones
+            if not self._wizfi.mqtt_connect(*self._broker, retries=1):
+                self._backoff.fail()
+                return 0
+            self._backoff.reset()
+        separator = self._separator
+        if separator and not self._wizfi.has_feature("mqtt_pubsend"):
+            # AT+MQTTPUB can't carry line breaks
+            if b"\r" in separator or b"\n" in separator:
+                separator = None
+        for _ in range(max_publishes):
+            if not self.pending:
+                break
+            batch, spill_offset, from_ram = self._peek(separator)
+            try:
+                if len(batch) == 1:
+                    ok = self._wizfi.mqtt_publish(batch[0])
+                else:
+                    ok = self._wizfi.mqtt_publish(separator.join(batch))
+            except ValueError:
+                # this firmware can never send it
+                self.dropped += len(batch)
+                self._commit(len(batch) - from_ram, spill_offset, from_ram)
+                continue
+            if not ok:
+                self._wizfi.is_mqtt_conn = False
+                self._backoff.fail()
+                break
+            self._commit(len(batch) - from_ram, spill_offset, from_ram)
+            self.publishes += 1
+            self.sent += len(batch)
+            sent += len(batch)
+        return sent
+
+    def _peek(self, separator: Optional[bytes]) -> Tuple[List[bytes], int, int]:
+        """The oldest messages that fit in one publish, flash first.
+        Returns (messages, new spill offset, how many came from RAM)"""
+        batch = []
+        size = 0
+        offset = self._spill_offset
+        if self._spill_count:
+            with open(self._spill_path, "rb") as file:
+                file.seek(offset)
+                while offset < self._spill_end:
+                    header = file.read(2)
+                    length = (header[0] << 8) | header[1]
+                    if batch and (
+                        not separator
+                        or size + len(separator) + length > self._max_batch_bytes
+                    ):
+                        return batch, offset, 0
+                    batch.append(file.read(length))
+                    size += length + (len(separator) if separator else 0)
+                    offset += 2 + length
+        from_ram = 0
+        for message in self._queue:
+            if batch and (
+                not separator
+                or size + len(separator) + len(message) > self._max_batch_bytes
+            ):
+                break
+            batch.append(message)
+            size += len(message) + (len(separator) if separator else 0)
+            from_ram += 1
+        return batch, offset, from_ram
+
+    def _commit(self, from_spill: int, spill_offset: int, from_ram: int) -> None:
+        """Forget messages that have been sent"""
+        if from_spill:
+            self._spill_count -= from_spill
+            self._spill_offset = spill_offset
+            if not self._spill_count:
+                self._remove_spill()
+            else:
+                self._save_offset()
+        del self._queue[:from_ram]
+
+    def _save_offset(self) -> None:
+        """Record how far the spill file has been sent"""
+        try:
+            with open(self._spill_path + ".off", "wb") as file:
+                file.write(self._spill_offset.to_bytes(4, "big"))
+        except OSError:
+            pass  # worst case those messages go out again
+
+    def _spill(self, message: bytes) -> bool:
+        """Append a message to the spill file, False if there's no room"""
+        if not self._spill_path or len(message) > 0xFFFF:
+            return False
+        if self._spill_end + 2 + len(message) > self._max_spill_bytes:
+            return False
+        try:
+            # write at our own end, past any torn record from a power cut
+            with open(self._spill_path, "r+b" if self._spill_end else "wb") as file:
+                file.seek(self._spill_end)
+                file.write(bytes((len(message) >> 8, len(message) & 0xFF)))
+                file.write(message)
+        except OSError:
+            return False
+        self._spill_end += 2 + len(message)
+        self._spill_count += 1
+        self.spilled += 1
+        return True
+
+    def _load_spill(self) -> None:
+        """Pick up messages left on flash by an earlier run, skipping the
+        ones it already sent"""
+        sent_to = 0
+        try:
+            with open(self._spill_path + ".off", "rb") as file:
+                offset = file.read(4)
+            if len(offset) == 4:
+                sent_to = int.from_bytes(offset, "big")
+        except OSError:
+            pass
+        try:
+            with open(self._spill_path, "rb") as file:
+                while True:
+                    header = file.read(2)
+                    if len(header) < 2:
+                        break
+                    length = (header[0] << 8) | header[1]
+                    if len(file.read(length)) < length:
+                        break
+                    self._spill_end += 2 + length
+                    if self._spill_end <= sent_to:
+                        self._spill_offset = self._spill_end
+                    else:
+                        self._spill_count += 1
+        except OSError:
+            pass
+        if self._spill_end and not self._spill_count:
+            self._remove_spill()  # all of it went out before the reset
+
+    def _remove_spill(self) -> None:
+        self._spill_offset = 0
+        self._spill_end = 0
+        for path in (self._spill_path, self._spill_path + ".off"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class MQTTSupervisor:
+    """Keeps the firmware MQTT connection up. Broker and AP state is followed
+    from the module's CLOSED / WIFI DISCONNECT / WIFI GOT IP messages, the
+    link is only checked when nothing else has happened for 'keep_alive'
+    seconds, and reconnects use jittered exponential backoff so a fleet of
+    devices doesn't hit the broker at the same moment. Before reconnecting
+    the MQTT user info and topics are restored with mqtt_restore()"""
+
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+
+    def __init__(
+        self,
+        wizfi: WizFi_ATcontrol,
+        broker_ip: str,
+        broker_port: int = 1883,
+        auth_enable: int = 0,
+        *,
+        secrets: Optional[Dict[str, Union[str, int]]] = None,
+        keep_alive: int = 10,
+        backoff_ms: int = 1000,
+        max_backoff_ms: int = 60000
+    ) -> None:
+        """
+        :param WizFi_ATcontrol wizfi: The WizFi360 object we are using
+        :param str broker_ip: Broker to (re)connect to with mqtt_connect()
+        :param dict secrets: (Optional) Used to rejoin the AP when it drops
+        :param int keep_alive: Seconds of silence before we check the link
+        """
+        self._wizfi = wizfi
+        self._broker = (auth_enable, broker_ip, broker_port)
+        self._secrets = secrets
+        self._keep_alive_ms = keep_alive * 1000
+        self._backoff = _Backoff(backoff_ms, max_backoff_ms)
+        self._last_activity = time.ticks_ms()
+        self._down_since = None
+        self.ap_connected = True
+        self.outages = 0
+        self.last_outage_ms = 0
+        self.total_outage_ms = 0
+        wizfi.add_urc_handler(self._on_line)
+
+    @property
+    def connected(self) -> bool:
+        """True while the broker connection is up"""
+        return self._wizfi.is_mqtt_conn
+
+    def _on_line(self, line: bytes) -> bool:
+        self._last_activity = time.ticks_ms()
+        if line == b"CLOSED":
+            self._broker_lost()
+        elif line == b"WIFI DISCONNECT":
+            self.ap_connected = False
+            self._broker_lost()
+        elif line in (b"WIFI CONNECTED", b"WIFI GOT IP"):
+            self.ap_connected = True
+        return False  # others may want these too
+
+    def _broker_lost(self) -> None:
+        if self._wizfi.is_mqtt_conn:
+            self._wizfi.is_mqtt_conn = False
+            self._down_since = time.ticks_ms()
+
+    def note_activity(self) -> None:
+        """Tell us the link just carried traffic, so no check is needed"""
+        self._last_activity = time.ticks_ms()
+
+    def publish(self, message: bytes) -> bool:
+        """mqtt_publish() that counts as activity and notices failures"""
+        if not self._wizfi.is_mqtt_conn:
+            return False
+        if self._wizfi.mqtt_publish(message):
+            self.note_activity()
+            return True
+        self._broker_lost()
+        return False
+
+    def service(self) -> bool:
+        """Call often from the main loop. Handles pending module messages,
+        checks an idle link and reconnects when the backoff allows.
+        Returns True while the broker connection is up"""
+        self._wizfi.poll_urc()
+        if self._wizfi.is_mqtt_conn:
+            idle = time.ticks_diff(time.ticks_ms(), self._last_activity)
+            if idle >= self._keep_alive_ms:
+                self._check_link()
+            return self._wizfi.is_mqtt_conn
+        if not self._backoff.ready():
+            return False
+        try:
+            if not self.ap_connected:
+                if not self._secrets:
+                    return False
+                self._wizfi.connect(self._secrets)
+                self.ap_connected = True
+            if self._wizfi.mqtt_restore() and self._wizfi.mqtt_connect(*self._broker):
+                self._reconnected()
+                return True
+        except (OKError, RuntimeError) as error:
+            print("MQTT reconnect failed:", error)
+        self._backoff.fail()
+        return False
+
+    def _check_link(self) -> None:
+        """Ask the module (not the broker) whether the link is still open"""
+        try:
+            stat = self._wizfi.status
+        except (OKError, RuntimeError):
+            stat = None
+        self.note_activity()
+        if stat == self._wizfi.STATUS_NOTCONNECTED:
+            self.ap_connected = False
+        if stat in (self._wizfi.STATUS_SOCKETCLOSED, self._wizfi.STATUS_NOTCONNECTED):
+            self._broker_lost()
+
+    def _reconnected(self) -> None:
+        self._backoff.reset()
+        self.note_activity()
+        if self._down_since is not None:
+            self.outages += 1
+            self.last_outage_ms = time.ticks_diff(time.ticks_ms(), self._down_since)
+            self.total_outage_ms += self.last_outage_ms
+            self._down_since = None
+
+    def close(self) -> None:
+        """Stop listening to the module"""
+        self._wizfi.remove_urc_handler(self._on_line)
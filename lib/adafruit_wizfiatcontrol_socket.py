@@ -29,7 +29,8 @@ Implementation Notes
 
 """
 
-
+import errno
+import time
 from micropython import const
 
 try:
@@ -49,6 +50,10 @@ def set_interface(iface: WizFi_ATcontrol) -> None:
 
 SOCK_STREAM = const(1)
 AF_INET = const(2)
+MAX_SOCKETS = const(1)  # the WizFi360 runs a single link in this mode
+
+POLLIN = const(0x0001)
+POLLHUP = const(0x0010)
 
 # pylint: disable=too-many-arguments, unused-argument
 def getaddrinfo(
@@ -61,15 +66,59 @@ def getaddrinfo(
 ) -> List[Tuple[int, int, int, str, Tuple[str, int]]]:
     """Given a hostname and a port name, return a 'socket.getaddrinfo'
     compatible list of tuples. Honestly, we ignore anything but host & port"""
+    return _getaddrinfo(_the_interface, host, port, socktype, proto)
+
+
+def _getaddrinfo(
+    iface: WizFi_ATcontrol, host: str, port: int, socktype: int, proto: int
+) -> List[Tuple[int, int, int, str, Tuple[str, int]]]:
     if not isinstance(port, int):
         raise RuntimeError("port must be an integer")
-    ipaddr = _the_interface.nslookup(host)
+    ipaddr = iface.nslookup(host)
     return [(AF_INET, socktype, proto, "", (ipaddr, port))]
 
 
 # pylint: enable=too-many-arguments, unused-argument
 
 
+class SocketPool:
+    """The 'socket' interface bound to one WizFi360, instead of the module
+    global set with set_interface(). Use one pool per module to drive
+    several WizFi360s from one board"""
+
+    SOCK_STREAM = SOCK_STREAM
+    AF_INET = AF_INET
+    MAX_SOCKETS = MAX_SOCKETS
+
+    def __init__(self, iface: WizFi_ATcontrol) -> None:
+        self.iface = iface
+
+    # pylint: disable=too-many-arguments, unused-argument, redefined-builtin
+    def getaddrinfo(
+        self,
+        host: str,
+        port: int,
+        family: int = 0,
+        socktype: int = 0,
+        proto: int = 0,
+        flags: int = 0,
+    ) -> List[Tuple[int, int, int, str, Tuple[str, int]]]:
+        """'socket.getaddrinfo' on this pool's module"""
+        return _getaddrinfo(self.iface, host, port, socktype, proto)
+
+    def socket(
+        self,
+        family: int = AF_INET,
+        type: int = SOCK_STREAM,
+        proto: int = 0,
+        fileno: Optional[int] = None,
+    ) -> "socket":
+        """A socket that talks through this pool's module"""
+        return socket(family, type, proto, fileno, iface=self.iface)
+
+    # pylint: enable=too-many-arguments, unused-argument, redefined-builtin
+
+
 # pylint: disable=unused-argument, redefined-builtin, invalid-name
 class socket:
     """A simplified implementation of the Python 'socket' class, for connecting
@@ -81,13 +130,31 @@ class socket:
         type: int = SOCK_STREAM,
         proto: int = 0,
         fileno: Optional[int] = None,
+        *,
+        iface: Optional[WizFi_ATcontrol] = None,
+        buffer_size: int = 2048,
+        send_buffer_size: int = 0
     ) -> None:
         if family != AF_INET:
             raise RuntimeError("Only AF_INET family supported")
         if type != SOCK_STREAM:
             raise RuntimeError("Only SOCK_STREAM type supported")
-        self._buffer = b""
-        self.settimeout(0)
+        self._iface = iface or _the_interface
+        # received data lives in _rx[_start:_end], _scan is where the search
+        # for the next line ending picks up again
+        self._rx = bytearray(buffer_size)
+        self._rx_view = memoryview(self._rx)
+        self._start = 0
+        self._end = 0
+        self._scan = 0
+        self._overflow = None
+        # small writes collect in _tx[:_tx_len] when there is a send buffer
+        self._tx = None
+        self._tx_len = 0
+        self._link = None  # the iface's link_serial while we own the link
+        if send_buffer_size:
+            self._set_send_buffer(send_buffer_size)
+        self.settimeout(None)
 
     def connect(self, address: Tuple[str, int], conntype: Optional[str] = None) -> None:
         """Connect the socket to the 'address' (which should be dotted quad IP). 'conntype'
@@ -104,52 +171,253 @@ class socket:
             elif port == 1883:
                 conntype = "TCP"
 
-        if not _the_interface.socket_connect(
+        if not self._iface.socket_connect(
             conntype, host, port, keepalive=10, retries=3
         ):
             raise RuntimeError("Failed to connect to host", host)
-        self._buffer = b""
+        self._link = self._iface.link_serial
+        self._reset_buffer()
+
+    @property
+    def connected(self) -> bool:
+        """True while our link is up: the module hasn't reported it CLOSED
+        and no other socket has connected since. Doesn't block"""
+        if self._link != self._iface.link_serial:
+            return False
+        self._iface.socket_available()  # catch up on CLOSED messages
+        return self._iface.socket_open
+
+    def send(self, data: bytes) -> int:
+        """Send some data to the socket. With a send buffer, small writes are
+        collected and go out as one CIPSEND when the buffer fills, on flush()
+        or before the next read"""
+        size = len(data)
+        if self._tx is None:
+            self._send_now(data)
+            return size
+        if self._tx_len + size > len(self._tx):
+            self.flush()
+        if size >= len(self._tx):
+            self._send_now(data)
+        else:
+            self._tx_view[self._tx_len : self._tx_len + size] = data
+            self._tx_len += size
+        return size
+
+    def write(self, data: bytes) -> int:
+        """File style send()"""
+        return self.send(data)
+
+    def flush(self) -> None:
+        """Send whatever the send buffer holds"""
+        if self._tx_len:
+            size = self._tx_len
+            self._tx_len = 0
+            self._send_now(self._tx_view[:size])
+
+    def _send_now(self, data: bytes) -> None:
+        if not self._iface.socket_send(data):
+            raise RuntimeError("Failed to send data")
+
+    def _set_send_buffer(self, size: int) -> None:
+        self._tx = bytearray(size)
+        self._tx_view = memoryview(self._tx)
+        self._tx_len = 0
+
+    def makefile(self, mode: str = "rb", buffering: int = 512) -> "socket":
+        """File-like use of the socket: it already reads like a file, a
+        writing 'mode' turns on a 'buffering' byte send buffer"""
+        if ("w" in mode or "a" in mode) and buffering > 0 and self._tx is None:
+            self._set_send_buffer(buffering)
+        return self
+
+    def _reset_buffer(self) -> None:
+        self._start = self._end = self._scan = 0
+        self._overflow = None
+
+    def _fill(self, timeout: int) -> int:
+        """Receive more data behind what's buffered, returns how much"""
+        self.flush()  # the other side may be waiting for what we wrote
+        data = self._overflow
+        self._overflow = None
+        if data is None:
+            data = self._iface.socket_receive(timeout=timeout)
+            if not data:
+                return 0
+            data = memoryview(data)
+        capacity = len(self._rx)
+        if self._end + len(data) > capacity and self._start:
+            # make room by moving the unread bytes to the front, once
+            unread = self._end - self._start
+            self._rx_view[:unread] = self._rx_view[self._start : self._end]
+            self._scan -= self._start
+            self._start = 0
+            self._end = unread
+        take = min(len(data), capacity - self._end)
+        self._rx_view[self._end : self._end + take] = data[:take]
+        self._end += take
+        if take < len(data):
+            self._overflow = data[take:]
+        return take
+
+    def _find_line_end(self) -> int:
+        """Index of the next '\r\n' in the buffer or -1, never rescanning"""
+        rx = self._rx
+        end = self._end
+        i = max(self._scan, self._start)
+        if hasattr(rx, "find"):
+            index = rx.find(b"\r\n", i, end)
+        else:
+            index = -1
+            while i < end - 1:
+                if rx[i] == 13 and rx[i + 1] == 10:
+                    index = i
+                    break
+                i += 1
+        self._scan = index if index >= 0 else max(end - 1, self._start)
+        return index
+
+    def _take(self, num: int) -> bytes:
+        """Pop up to 'num' buffered bytes as a bytes object"""
+        num = min(num, self._end - self._start)
+        ret = bytes(self._rx_view[self._start : self._start + num])
+        self._start += num
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+        return ret
+
+    def _wait(self) -> None:
+        """Make sure there is something to read: data, or the end of the
+        stream once the link is closed. Raises OSError on timeout"""
+        if self._start == self._end and not self._fill(self._timeout):
+            self._check_open()
 
-    def send(self, data: bytes) -> None:  # pylint: disable=no-self-use
-        """Send some data to the socket"""
-        _the_interface.socket_send(data)
+    def _check_open(self) -> None:
+        """Nothing arrived in time: that's the end of the stream if the link
+        closed, a timeout otherwise"""
+        if self._link == self._iface.link_serial and self._iface.socket_open:
+            raise OSError(errno.EAGAIN if self._timeout == 0 else errno.ETIMEDOUT)
 
     def readline(self) -> bytes:
         """Attempt to return as many bytes as we can up to but not including '\r\n'"""
-        if b"\r\n" not in self._buffer:
-            # there's no line already in there, read some more
-            self._buffer = self._buffer + _the_interface.socket_receive(timeout=3)
-            # print(self._buffer)
-        firstline, self._buffer = self._buffer.split(b"\r\n", 1)
-        return firstline
+        while True:
+            index = self._find_line_end()
+            if index >= 0:
+                line = self._take(index - self._start)
+                self._start += 2
+                if self._start >= self._end:
+                    self._start = self._end = self._scan = 0
+                return line
+            if self._start == 0 and self._end == len(self._rx):
+                # line longer than the buffer, hand it over in pieces but
+                # keep a trailing '\r' so the line ending stays whole
+                return self._take(self._end - 1 if self._rx[-1] == 13 else self._end)
+            if not self._fill(self._timeout):
+                if self._start == self._end:
+                    self._check_open()
+                # no line ending coming, hand over what we have
+                return self._take(self._end - self._start)
 
     def recv(self, num: int = 0) -> bytes:
         """Read up to 'num' bytes from the socket, this may be buffered internally!
-        If 'num' isnt specified, return everything in the buffer."""
+        If 'num' isnt specified, return everything in the buffer. Returns b""
+        once the link is closed"""
+        self._wait()
         if num == 0:
-            # read as much as we can
-            ret = self._buffer + _the_interface.socket_receive(timeout=self._timeout)
-            self._buffer = b""
-        else:
-            if self._buffer == b"":
-                self._buffer = self._buffer + _the_interface.socket_receive(
-                    timeout=self._timeout
-                )
-            ret = self._buffer[:num]
-            self._buffer = self._buffer[num:]
-        return ret
+            num = self._end - self._start
+        return self._take(num)
+
+    def recv_into(self, buffer: bytearray, nbytes: int = 0) -> int:
+        """Read up to 'nbytes' (or len(buffer)) bytes into 'buffer' without
+        an intermediate bytes object. Returns the number of bytes read"""
+        self._wait()
+        if not nbytes or nbytes > len(buffer):
+            nbytes = len(buffer)
+        num = min(nbytes, self._end - self._start)
+        buffer[:num] = self._rx_view[self._start : self._start + num]
+        self._start += num
+        if self._start == self._end:
+            self._start = self._end = self._scan = 0
+        return num
+
+    def readinto(self, buffer: bytearray) -> int:
+        """File style recv_into()"""
+        return self.recv_into(buffer)
 
     def close(self) -> None:
-        """Close the socket, after reading whatever remains"""
-        # read whatever's left
-        self._buffer = self._buffer + _the_interface.socket_receive(
-            timeout=self._timeout
-        )
-        _the_interface.socket_disconnect()
-
-    def settimeout(self, value: int) -> None:
-        """Set the read timeout for sockets, if value is 0 it will block"""
+        """Close the socket, after reading whatever remains. The module's
+        link is left alone if another socket has connected since"""
+        ours = self._link == self._iface.link_serial
+        self._link = None
+        if ours:
+            try:
+                self.flush()
+            except RuntimeError:
+                pass  # closing anyway
+        self._tx_len = 0
+        self._reset_buffer()
+        if ours:
+            # read whatever's left
+            self._iface.socket_receive(timeout=0)
+            self._iface.socket_disconnect()
+
+    def settimeout(self, value: Optional[float]) -> None:
+        """Set the read timeout in seconds. None blocks until data arrives or
+        the link closes, 0 makes reads non-blocking (OSError EAGAIN when
+        there is nothing yet), otherwise reads raise OSError ETIMEDOUT"""
         self._timeout = value
 
+    def setblocking(self, flag: bool) -> None:
+        """settimeout(None) if 'flag' else settimeout(0)"""
+        self.settimeout(None if flag else 0)
+
+    def _poll(self) -> int:
+        """POLLIN/POLLHUP readiness of this socket, without blocking"""
+        self.flush()
+        if self._start != self._end or self._overflow is not None:
+            return POLLIN
+        if self._iface.socket_available():
+            return POLLIN
+        if not self.connected:
+            return POLLIN | POLLHUP
+        return 0
+
+
+class poll:
+    """'select.poll' style readiness over several sockets, for serving
+    more than one WizFi360 from a single loop. Readiness comes from the
+    +IPD and CLOSED messages the modules send"""
+
+    def __init__(self) -> None:
+        self._sockets = {}
+
+    def register(self, sock: socket, eventmask: int = POLLIN) -> None:
+        """Watch 'sock' for 'eventmask' events, POLLHUP is always reported"""
+        self._sockets[sock] = eventmask
+
+    def modify(self, sock: socket, eventmask: int) -> None:
+        """Change the events watched on a registered socket"""
+        if sock not in self._sockets:
+            raise OSError(errno.ENOENT)
+        self._sockets[sock] = eventmask
+
+    def unregister(self, sock: socket) -> None:
+        """Stop watching 'sock'"""
+        self._sockets.pop(sock, None)
+
+    def poll(self, timeout: int = -1) -> List[Tuple[socket, int]]:
+        """Wait up to 'timeout' milliseconds (-1 forever, 0 not at all) for
+        a registered socket to become ready, returns (socket, events) pairs"""
+        stamp = time.ticks_ms()
+        while True:
+            ready = []
+            for sock, eventmask in self._sockets.items():
+                # pylint: disable=protected-access
+                events = sock._poll() & (eventmask | POLLHUP)
+                if events:
+                    ready.append((sock, events))
+            if ready or 0 <= timeout <= time.ticks_diff(time.ticks_ms(), stamp):
+                return ready
+
 
 # pylint: enable=unused-argument, redefined-builtin, invalid-name
@@ -12,6 +12,12 @@
 #     # Wi-Fi
 #     "ssid": "wiznet",
 #     "password": "0123456789",
+#     # Optional: skip DHCP with a static address
+#     "ip": "192.168.11.50",
+#     "gateway": "192.168.11.1",
+#     "netmask": "255.255.255.0",
+#     # Optional: or reuse the last DHCP lease on the next connect
+#     "reuse_lease": True,
 # }
 
 secrets = {